@@ -1,10 +1,8 @@
 import logging
-import webbrowser
 from pathlib import Path
 from sys import path
 
 import click
-import uvicorn
 
 path.append(str(Path(__file__).parent))
 
@@ -14,6 +12,8 @@ def render_outputs(html, open_browser: bool, path: Path):
     path.write_text(html)
 
     if open_browser:
+        import webbrowser
+
         webbrowser.open(str(path))
 
 
@@ -102,6 +102,7 @@ def render_ner(sentence: str, open_browser: bool, path: Path):
 @click.option("--host", default="0.0.0.0", help="Host address")
 def launch(host: str, port: int):
     """Launches the server on the specified host, listening on the specified port."""
+    import uvicorn
     from server import app, init_loggers
 
     init_loggers()
@@ -0,0 +1,266 @@
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from enum import Enum
+from os import getenv
+from typing import Any, Callable, Dict, Hashable, Iterator, MutableMapping, Optional
+
+
+class EvictionPolicy(str, Enum):
+    LRU = "lru"
+    LFU = "lfu"
+
+    def __str__(self):
+        return self.value
+
+
+def deep_sizeof(item: Any) -> int:
+    """Approximates the memory used by `item`, recursing into dicts, lists and tuples."""
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in item.items())
+    elif isinstance(item, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(x) for x in item)
+    return size
+
+
+def env_bytes(name: str, default: Optional[int] = None) -> Optional[int]:
+    """Reads a byte budget from the environment, accepting K/M/G suffixes. Returns
+    `default` if the variable is unset, and None (unbounded) if it is set to 0."""
+    value = getenv(name)
+    if value is None:
+        return default
+
+    value = value.strip().upper().removesuffix("B")
+    scale = 1
+    for suffix, multiplier in (("K", 2**10), ("M", 2**20), ("G", 2**30)):
+        if value.endswith(suffix):
+            value = value.removesuffix(suffix)
+            scale = multiplier
+            break
+
+    budget = int(float(value) * scale)
+    return budget or None
+
+
+class BoundedCache(MutableMapping):
+    """A mapping with an optional memory budget, in bytes. Once the budget is exceeded,
+    entries are evicted according to the subclass's policy until the cache fits again.
+    The cache tracks hits, misses and evictions - note that only `get` and `[]` count towards
+    hits and misses, while `in` and iteration leave both the statistics and the eviction order untouched.
+    Callers which fall back to an on-disk store after a miss report store hits with `store_hit`.
+    Reads and writes are guarded by a lock, as the cache is shared by request handler threads.
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = deep_sizeof,
+    ):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.evictions = 0
+        self._data: Dict[Hashable, Any] = {}
+        self._sizes: Dict[Hashable, int] = {}
+        self.lock = threading.RLock()
+
+    def _touch(self, key):
+        raise NotImplementedError
+
+    def _insert(self, key):
+        raise NotImplementedError
+
+    def _remove(self, key):
+        raise NotImplementedError
+
+    def _victim(self, keep) -> Hashable:
+        """Returns the next entry to evict, other than `keep`."""
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self._touch(key)
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self._data:
+                self.nbytes -= self._sizes[key]
+                self._touch(key)
+            else:
+                self._insert(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.nbytes += size
+            self._evict(keep=key)
+
+    def resize(self, key):
+        """Re-measures the entry under the given key, eg. after its value has lazily built more state,
+        evicting other entries if the cache no longer fits its budget."""
+        with self.lock:
+            if key not in self._data:
+                return
+            size = self.sizeof(self._data[key])
+            self.nbytes += size - self._sizes[key]
+            self._sizes[key] = size
+            self._evict(keep=key)
+
+    def store_hit(self):
+        """Counts a miss which was served from the on-disk store backing the cache."""
+        with self.lock:
+            self.store_hits += 1
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self._data[key]
+            self.nbytes -= self._sizes.pop(key)
+            self._remove(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self) -> Iterator:
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self._data):
+                del self[key]
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes and len(self._data) > 1:
+            del self[self._victim(keep)]
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "store_hits": self.store_hits,
+            "evictions": self.evictions,
+        }
+
+
+class LRUCache(BoundedCache):
+    """Evicts the least recently used entry first."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._order: OrderedDict = OrderedDict()
+
+    def _touch(self, key):
+        self._order.move_to_end(key)
+
+    def _insert(self, key):
+        self._order[key] = None
+
+    def _remove(self, key):
+        del self._order[key]
+
+    def _victim(self, keep):
+        return next(key for key in self._order if key != keep)
+
+
+class LFUCache(BoundedCache):
+    """Evicts the least frequently used entry first, breaking ties by recency.
+    Entries are kept in one insertion-ordered bucket per access count."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counts: Dict[Hashable, int] = {}
+        self._buckets: Dict[int, OrderedDict] = defaultdict(OrderedDict)
+
+    def _touch(self, key):
+        count = self._counts[key]
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+        self._counts[key] = count + 1
+        self._buckets[count + 1][key] = None
+
+    def _insert(self, key):
+        self._counts[key] = 1
+        self._buckets[1][key] = None
+
+    def _remove(self, key):
+        count = self._counts.pop(key)
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+    def _victim(self, keep):
+        for count in sorted(self._buckets):
+            for key in self._buckets[count]:
+                if key != keep:
+                    return key
+
+
+CACHE_TYPES = {
+    EvictionPolicy.LRU: LRUCache,
+    EvictionPolicy.LFU: LFUCache,
+}
+
+
+def make_cache(
+    max_bytes: Optional[int] = None,
+    policy: EvictionPolicy = EvictionPolicy.LRU,
+    sizeof: Callable[[Any], int] = deep_sizeof,
+) -> BoundedCache:
+    return CACHE_TYPES[EvictionPolicy(policy)](max_bytes, sizeof)
+
+
+class CachePerModel(dict):
+    """Lazily creates one cache per key (eg. per Pipeline) using `factory(key)`. Caches are created
+    under a lock, so that concurrent first requests for a key share the same cache."""
+
+    def __init__(self, factory: Callable[[Any], BoundedCache]):
+        super().__init__()
+        self.factory = factory
+        self.lock = threading.Lock()
+
+    def __missing__(self, key):
+        with self.lock:
+            if key not in self:
+                self[key] = self.factory(key)
+            return dict.__getitem__(self, key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            caches = list(self.items())
+        return {str(key): cache.stats() for key, cache in caches}
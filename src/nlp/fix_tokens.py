@@ -4,18 +4,30 @@
 # Refer to https://spacy.io/usage/rule-based-matching for information on pattern-matching
 # in spaCy.
 
-from typing import Optional
+from collections import defaultdict
+from functools import cached_property, lru_cache
+from typing import Dict, List, Optional, Tuple
 
 import spacy
 from spacy.lang.en import English
 from spacy.matcher import Matcher
 from spacy.tokens import Doc
 
-nlp = spacy.blank("en")
+try:
+    from pretokenize import pretoken_tag
+except ModuleNotFoundError:
+    from .pretokenize import pretoken_tag
+
+
+@lru_cache(maxsize=None)
+def blank_vocab():
+    """The vocab shared by all matchers. Created on first use, along with the matchers themselves,
+    so that importing this module stays cheap."""
+    return spacy.blank("en").vocab
 
 
 def matcher_with_rule(name, rule):
-    matcher = Matcher(nlp.vocab)
+    matcher = Matcher(blank_vocab())
     if isinstance(rule[0], list):
         matcher.add(name, rule)
     else:
@@ -74,12 +86,10 @@ ARITH = {
 ARITH_SIGN = {"ORTH": {"IN": ["%", "+", "-", "/", "*"]}}
 
 
-def ret_rule_to_matcher(rule):
+def ret_rule(rule):
     for i, sub_rule in enumerate(rule):
         if "LEMMA" in sub_rule:
-            matcher = Matcher(nlp.vocab)
-            matcher.add("RETURN", [rule])
-            return i, {"tag_": "RET", "pos_": "VERB"}, matcher
+            return i, {"tag_": "RET", "pos_": "VERB"}, rule
     raise ValueError("NOT A RET RULE")
 
 
@@ -87,11 +97,133 @@ def merge_bool_op(op):
     return [{"ORTH": c} for c in op]
 
 
-CODE_MATCHER = matcher_with_rule("CODE", [{"ORTH": "`"}, {"OP": "+"}, {"ORTH": "`"}])
-STR_MATCHER = matcher_with_rule("STR", [{"ORTH": '"'}, {"OP": "*"}, {"ORTH": '"'}])
-CHAR_MATCHER = matcher_with_rule(
-    "CHAR", [{"ORTH": "'"}, {"IS_ASCII": True, "LENGTH": 1}, {"ORTH": "'"}]
-)
+def as_patterns(rule) -> List[list]:
+    return rule if isinstance(rule[0], list) else [rule]
+
+
+class MergeRule:
+    """Merges every match of the given patterns into a single token with the given attributes.
+
+    All non-overlapping matches are merged in one retokenization, preferring matches in the order
+    that the matcher returns them - this produces the same tokens as merging the first match and rescanning
+    the document until no matches remain. Patterns containing wildcard tokens (ie. code spans and strings)
+    may match around a token merged by an earlier match - eg. in the tokens `` ` ` x ` ` ``, `` ` x ` `` is
+    merged first, and the rescan then merges all five tokens. So for these, a match which encloses earlier
+    matches takes their place, and the document is rescanned until a scan finds no further matches.
+    """
+
+    def __init__(self, attrs: dict, patterns: Dict[str, list]):
+        self.attrs = attrs
+        self.patterns = patterns
+        self.rescan = any(
+            set(token) <= {"OP"}
+            for rule in patterns.values()
+            for pattern in as_patterns(rule)
+            for token in pattern
+        )
+
+    @cached_property
+    def matcher(self) -> Matcher:
+        matcher = Matcher(blank_vocab())
+        for name, rule in self.patterns.items():
+            matcher.add(name, as_patterns(rule))
+        return matcher
+
+    def spans(self, doc: Doc) -> List[Tuple[int, int]]:
+        taken = bytearray(len(doc))
+        spans: Dict[int, int] = {}
+        for _, start, end in self.matcher(doc):
+            if taken[start] or taken[end - 1]:
+                continue
+            if any(taken[start:end]):
+                if not self.rescan:
+                    continue
+                for inner in [inner for inner in spans if start < inner < end]:
+                    del spans[inner]
+            taken[start:end] = b"\x01" * (end - start)
+            spans[start] = end
+        return sorted(spans.items())
+
+    def __call__(self, doc: Doc):
+        while True:
+            spans = self.spans(doc)
+            if not spans:
+                return
+            with doc.retokenize() as retokenizer:
+                for start, end in spans:
+                    retokenizer.merge(doc[start:end], attrs=self.attrs)
+            if not self.rescan:
+                return
+
+
+class WordRules:
+    """Applies a sequence of (index, attributes, pattern) rules, setting the attributes of the token at
+    the index of each match of the pattern. Rules are applied in order, and later rules see the attributes
+    set by earlier rules.
+
+    All rules are evaluated by a single Matcher, keyed by rule. When a rule changes a token,
+    only the matches of later rules which cover that token are recomputed, by rerunning the matcher
+    on the surrounding window of the document. This relies on word patterns having a fixed length
+    (ie. no "OP" quantifiers).
+    """
+
+    def __init__(self, rules: List[Tuple[int, dict, list]]):
+        self.rules = rules
+        self.window = max(
+            len(pattern) for _, _, rule in rules for pattern in as_patterns(rule)
+        )
+
+    @cached_property
+    def rule_ids(self) -> Dict[int, int]:
+        """Maps the match id of each rule to its index in `rules`."""
+        strings = blank_vocab().strings
+        return {strings.add(f"WORD_{i}"): i for i in range(len(self.rules))}
+
+    @cached_property
+    def matcher(self) -> Matcher:
+        matcher = Matcher(blank_vocab())
+        for i, (_, _, rule) in enumerate(self.rules):
+            matcher.add(f"WORD_{i}", as_patterns(rule))
+        return matcher
+
+    def _refresh(self, doc: Doc, matches: Dict[int, set], dirty: set, after: int):
+        """Recomputes the matches of all rules after `after` which cover any dirty token."""
+        for rule, spans in matches.items():
+            if rule > after:
+                spans.difference_update(
+                    [(start, end) for start, end in spans if dirty.intersection(range(start, end))]
+                )
+
+        for i in sorted(dirty):
+            window = doc[max(0, i - self.window + 1) : i + self.window]
+            # Match ids are hashes from the matcher's own vocab, so they are mapped through `rule_ids`
+            # rather than resolved as Span labels in the doc's vocab
+            for match_id, start, end in self.matcher(window):
+                start, end = start + window.start, end + window.start
+                rule = self.rule_ids[match_id]
+                if rule > after and start <= i < end:
+                    matches[rule].add((start, end))
+
+    def __call__(self, doc: Doc):
+        matches = defaultdict(set)
+        for match_id, start, end in self.matcher(doc):
+            matches[self.rule_ids[match_id]].add((start, end))
+
+        for i, (idx, substitute, _) in enumerate(self.rules):
+            dirty = set()
+            for start, _ in matches.pop(i, ()):
+                token = doc[start + idx]
+                for attr, val in substitute.items():
+                    if getattr(token, attr) != val:
+                        setattr(token, attr, val)
+                        dirty.add(token.i)
+            if dirty:
+                self._refresh(doc, matches, dirty, after=i)
+
+
+CODE_PATTERN = [{"ORTH": "`"}, {"OP": "+"}, {"ORTH": "`"}]
+STR_PATTERN = [{"ORTH": '"'}, {"OP": "*"}, {"ORTH": '"'}]
+CHAR_PATTERN = [{"ORTH": "'"}, {"IS_ASCII": True, "LENGTH": 1}, {"ORTH": "'"}]
 # SOME_MATCHER = matcher_with_rule("SOME", [{"TEXT": "Some"}, {'ORTH': "("}, {"OP": "+"}, {'ORTH': ")"}])
 # LIFETIME_MATCHER = matcher_with_rule("LIFETIME", [{"ORTH": "'"}, {"IS_ASCII": True}])
 # REF_MATCHER = matcher_with_rule("REF",
@@ -130,19 +262,19 @@ CHAR_MATCHER = matcher_with_rule(
 #
 # ])
 
-BOOL_OPS = [
-    ({"POS": "NOUN", "TAG": "BOOL_OP"}, matcher_with_rule(op, merge_bool_op(op)))
-    for op in ["!=", "==", "&&", "||"]
-]
+BOOL_OPS = {op: merge_bool_op(op) for op in ["!=", "==", "&&", "||"]}
 
 # WORD_MATCHERS_0 = [(idx, tag, matcher_with_rule(tag["tag_"], rule)) for idx, tag, rule in [
 #     (0, {"tag_": "PATH"}, [{"TEXT": {"REGEX": "^(::)?[a-zA-Z_][a-zA-Z0-9_]*(::[a-zA-Z_][a-zA-Z0-9_]*)+$"}}]),
 # ]]
 
-MERGE_MATCHERS = BOOL_OPS + [
-    ({"POS": "NOUN", "TAG": "CODE"}, CODE_MATCHER),
-    ({"POS": "NOUN", "TAG": "STR"}, STR_MATCHER),
-    ({"POS": "NOUN", "TAG": "CHAR"}, CHAR_MATCHER),
+# Merges are applied in order - eg. quotes inside of code spans are merged into the code span
+# before strings are merged.
+MERGE_RULES = [
+    MergeRule({"POS": "NOUN", "TAG": "BOOL_OP"}, BOOL_OPS),
+    MergeRule({"POS": "NOUN", "TAG": "CODE"}, {"CODE": CODE_PATTERN}),
+    MergeRule({"POS": "NOUN", "TAG": "STR"}, {"STR": STR_PATTERN}),
+    MergeRule({"POS": "NOUN", "TAG": "CHAR"}, {"CHAR": CHAR_PATTERN}),
     # ({"POS": "NOUN", "TAG": "OPTION"}, SOME_MATCHER),
     # ({"POS": "NOUN", "TAG": "LIFETIME"}, LIFETIME_MATCHER),
     # ({"POS": "NOUN", "TAG": "REF"}, REF_MATCHER),
@@ -150,9 +282,8 @@ MERGE_MATCHERS = BOOL_OPS + [
     # ({"POS": "NOUN", "TAG": "CALL"}, FN_CALL)
 ]
 
-WORD_MATCHERS = [
-    (idx, tag, matcher_with_rule(tag["tag_"], rule))
-    for idx, tag, rule in [
+WORD_RULES = WordRules(
+    [
         (0, {"tag_": "IF"}, [lemma("if")]),
         (0, {"tag_": "FOR"}, [lemma("for"), tag("DT")]),
         (
@@ -214,7 +345,8 @@ WORD_MATCHERS = [
         (0, {"tag_": "VBZ"}, [lemma("set"), IS_OBJ, tag("IN"), IS_OBJ]),
         (0, {"tag_": "VBZ"}, [lemma("set"), IS_OBJ, tag("TO"), IS_OBJ]),
     ]
-] + [ret_rule_to_matcher(rule) for rule in RET_RULES]
+    + [ret_rule(rule) for rule in RET_RULES]
+)
 
 
 def get_literal_tag(word: str) -> Optional[str]:
@@ -252,18 +384,75 @@ def fix_tokens(doc: Doc):
     #         for attr, val in substitute.items():
     #             setattr(doc[start + idx], attr, val)
 
-    for attrs, matcher in MERGE_MATCHERS:
-        while True:
-            try:
-                with doc.retokenize() as retokenizer:
-                    _, start, end = next(iter(matcher(doc)))
-                    retokenizer.merge(doc[start:end], attrs=attrs)
-            except StopIteration:
-                break
-
-    for idx, substitute, matcher in WORD_MATCHERS:
+    tag_pretokens(doc)
+
+    for merge_rule in MERGE_RULES:
+        merge_rule(doc)
+
+    WORD_RULES(doc)
+
+    return doc
+
+
+def tag_pretokens(doc: Doc):
+    """Tags code spans, strings, chars and boolean operators which were emitted as single tokens
+    by `CodeTokenizer`, as the merge rules would have tagged them. Their lemma is their text, as the
+    lemmatizer only sees the whole token (see STORE_VERSION)."""
+    for token in doc:
+        tag = pretoken_tag(token.text)
+        if tag is not None:
+            token.tag_ = tag
+            token.pos_ = "NOUN"
+            token.lemma_ = token.text
+
+
+def fix_tokens_reference(doc: Doc):
+    """The original implementation of `fix_tokens`, which rescans the document after every merge,
+    and runs one matcher per rule. Used to check and benchmark `fix_tokens`."""
+    tag_pretokens(doc)
+
+    for merge_rule in MERGE_RULES:
+        for name, rule in merge_rule.patterns.items():
+            matcher = matcher_with_rule(name, rule)
+            while True:
+                try:
+                    with doc.retokenize() as retokenizer:
+                        _, start, end = next(iter(matcher(doc)))
+                        retokenizer.merge(doc[start:end], attrs=merge_rule.attrs)
+                except StopIteration:
+                    break
+
+    for idx, substitute, rule in WORD_RULES.rules:
+        matcher = matcher_with_rule(substitute["tag_"], rule)
         for _, start, end in matcher(doc):
             for attr, val in substitute.items():
                 setattr(doc[start + idx], attr, val)
 
     return doc
+
+
+if __name__ == "__main__":
+    import time
+
+    sentences = [
+        "Returns `true` if `self == other` and `self.len() != 0`, or `false` if either `a` or `b` is \"empty\".",
+        "Shifts `self` to the left by `n` bits, returning `None` if `n` is greater than `u32::BITS` or `n == 0`.",
+        "Removes the last element from a vector and returns it, or `None` if it is empty.",
+        "Returns the number of `'a'` characters in `s`, where `s.len() > 0 && s.is_ascii()` holds.",
+        "If `x` is 5, `y` is set to `x` plus 2u32, and `z` is multiplied by 3.5f32.",
+        "Accepts versions 1.2.3 and ranges like 3-4, and returns an error if a!=b.",
+        "Formats ``x`` as ` ` x ` ` a `, and `a``b` as \"``\".",
+    ]
+    # Long doc comments, with many code spans per sentence
+    doc_comments = [" ".join(sentences * 8)] * 20
+
+    tagger = spacy.load("en_core_web_sm")
+    docs = list(tagger.pipe(doc_comments))
+
+    for name, impl in [("reference", fix_tokens_reference), ("fix_tokens", fix_tokens)]:
+        copies = [doc.copy() for doc in docs]
+        start = time.perf_counter()
+        for doc in copies:
+            impl(doc)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.4f}s for {len(docs)} doc comments")
@@ -1,32 +1,311 @@
+import asyncio
 import json
+import threading
+from concurrent.futures import Future
 from os import getenv
+from typing import Dict, List, Optional
 
-import requests
+import httpx
 import unidecode
 
+try:
+    from cache import BoundedCache, EvictionPolicy, env_bytes, make_cache
+    from store import SegmentStore, sentence_key
+except ModuleNotFoundError:
+    from .cache import BoundedCache, EvictionPolicy, env_bytes, make_cache
+    from .store import SegmentStore, sentence_key
+
 SRL_URL = getenv("SRL_SERVICE_URL", "http://127.0.0.8:701/srl")
 NER_URL = getenv("NER_SERVICE_URL", "http://127.0.0.8:702/ner")
+# Waiting for a free connection from the pool is not limited, since batches queue on the pool
+TIMEOUT = httpx.Timeout(
+    float(getenv("NLP_SERVICE_TIMEOUT", 60)), connect=5.0, pool=None
+)
+LIMITS = httpx.Limits(
+    max_connections=int(getenv("NLP_SERVICE_CONNECTIONS", 16)),
+    max_keepalive_connections=int(getenv("NLP_SERVICE_CONNECTIONS", 16)),
+)
+# The on-disk entity store used by the server
+ENTITY_STORE_PATH = "./cache/entities"
 
 
 class NLPError(ValueError):
     pass
 
 
-def request_helper(url: str, msg: dict) -> dict:
-    res = requests.post(url, json=msg)
-    body = json.loads(res.content.decode("utf-8"))
-    if not res.ok:
-        raise NLPError(body.get("message", "Unknown server error."))
+class ServiceClient:
+    """Owns a pooled async HTTP client, which runs on a dedicated event loop thread, so that
+    connections are reused across calls from both synchronous code and other event loops."""
 
-    if "message" in body and not body["success"]:
-        raise NLPError(body["message"])
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="nlp-services", daemon=True
+        )
+        self.thread.start()
+        self.client: Optional[httpx.AsyncClient] = None
 
-    return body
+    async def _client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=TIMEOUT, limits=LIMITS)
+        return self.client
 
+    def submit(self, coro):
+        """Runs the coroutine on the client's event loop, returning a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
-def ner_and_srl(text: str, srl_url=SRL_URL, ner_url=NER_URL) -> dict:
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    async def post(self, url: str, msg: dict) -> dict:
+        client = await self._client()
+        try:
+            res = await client.post(url, json=msg)
+        except httpx.HTTPError as e:
+            raise NLPError(f"Request to {url} failed: {e}") from e
+
+        try:
+            body = json.loads(res.content.decode("utf-8"))
+        except ValueError as e:
+            # Both JSONDecodeError and UnicodeDecodeError are ValueErrors
+            raise NLPError(
+                f"Invalid response from {url} ({res.status_code}): {e}"
+            ) from e
+        if not isinstance(body, dict):
+            raise NLPError(f"Invalid response from {url} ({res.status_code})")
+        if not res.is_success:
+            raise NLPError(body.get("message", "Unknown server error."))
+
+        if "message" in body and not body.get("success"):
+            raise NLPError(body["message"])
+
+        return body
+
+    def close(self):
+        if self.client is not None:
+            self.run(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_SERVICE_CLIENT: Optional[ServiceClient] = None
+_SERVICE_CLIENT_LOCK = threading.Lock()
+
+
+def service_client() -> ServiceClient:
+    global _SERVICE_CLIENT
+    with _SERVICE_CLIENT_LOCK:
+        if _SERVICE_CLIENT is None:
+            _SERVICE_CLIENT = ServiceClient()
+        return _SERVICE_CLIENT
+
+
+def close_service_client():
+    global _SERVICE_CLIENT
+    with _SERVICE_CLIENT_LOCK:
+        if _SERVICE_CLIENT is not None:
+            _SERVICE_CLIENT.close()
+            _SERVICE_CLIENT = None
+
+
+async def ner_and_srl_async(text: str, srl_url=SRL_URL, ner_url=NER_URL) -> dict:
+    """Requests NER and SRL analysis of the text concurrently. Must be awaited on the
+    service client's event loop (see `ner_and_srl` and `ner_and_srl_many`)."""
+    client = service_client()
     msg = {"text": unidecode.unidecode(text)}
-    return {**request_helper(ner_url, msg), **request_helper(srl_url, msg), **msg}
+    ner, srl = await asyncio.gather(
+        client.post(ner_url, msg), client.post(srl_url, msg)
+    )
+    return {**ner, **srl, **msg}
+
+
+async def ner_and_srl_many_async(
+    texts: List[str], srl_url=SRL_URL, ner_url=NER_URL
+) -> List[dict]:
+    return await asyncio.gather(
+        *(ner_and_srl_async(text, srl_url, ner_url) for text in texts)
+    )
+
+
+def ner_and_srl(text: str, srl_url=SRL_URL, ner_url=NER_URL) -> dict:
+    client = service_client()
+    return client.run(ner_and_srl_async(text, srl_url, ner_url))
+
+
+def ner_and_srl_many(texts: List[str], srl_url=SRL_URL, ner_url=NER_URL) -> List[dict]:
+    """Performs NER and SRL analysis of all texts, issuing requests concurrently over a shared
+    connection pool. Results are in the same order as `texts`."""
+    client = service_client()
+    return client.run(ner_and_srl_many_async(texts, srl_url, ner_url))
+
+
+def spacy_entities(sentence: str, res: dict) -> dict:
+    """Converts the output of `ner_and_srl` to the format used by spaCy's displacy. Raises an
+    NLPError if the services responded with entities or predicates of an unexpected shape."""
+    try:
+        return _spacy_entities(sentence, res)
+    except (KeyError, TypeError, AttributeError) as e:
+        raise NLPError(f"Malformed NER or SRL response: {e!r}") from e
+
+
+def _spacy_entities(sentence: str, res: dict) -> dict:
+    ents = []
+    for item in res["entities"]:
+        ent = {
+            "start": item["pos"],
+            "end": item["pos"] + len(item["text"]),
+            "label": item["type"],
+        }
+        ents.append(ent)
+
+    spacy_ner = {"text": sentence, "ents": ents}
+
+    spacy_srls = []
+    for item in res["predicates"]:
+        ents = []
+        predicate = item["predicate"]
+        predicate.pop("len")
+        predicate["start"] = predicate.pop("pos")
+        predicate["end"] = len(predicate.pop("text")) + predicate["start"]
+        predicate["label"] = "PRED"
+        ents.append(predicate)
+        for label, metadata in item["roles"].items():
+            ent = {
+                "start": metadata["pos"],
+                "end": metadata["pos"] + len(metadata["text"]),
+                "label": label,
+            }
+            ents.append(ent)
+        spacy_srl = {"text": sentence, "ents": ents}
+        spacy_srls.append(spacy_srl)
+
+    if not spacy_srls:
+        spacy_srls.append({"text": sentence, "ents": []})
+
+    return {"ner": spacy_ner, "srl": spacy_srls}
+
+
+def entity_cache() -> BoundedCache:
+    return make_cache(
+        env_bytes("ENTITY_CACHE_SIZE", 64 * 2**20),
+        EvictionPolicy(getenv("CACHE_POLICY", EvictionPolicy.LRU)),
+    )
+
+
+class EntityAnalyzer:
+    """Requests NER and SRL analysis from the NER and SRL services, caching the results.
+
+    The results do not depend on a spaCy model, so a single cache, on-disk store, and set of in-flight
+    requests is shared by all callers - each sentence is requested from the services at most once.
+    """
+
+    CACHE = entity_cache()
+    STORE: Optional[SegmentStore] = None
+    INFLIGHT: Dict[str, Future] = {}
+    LOCK = threading.Lock()
+
+    def __init__(self):
+        self.cache = EntityAnalyzer.CACHE
+        self.inflight = EntityAnalyzer.INFLIGHT
+        self.store = EntityAnalyzer.STORE
+
+    @classmethod
+    def from_cache(cls, path: str = ENTITY_STORE_PATH) -> "EntityAnalyzer":
+        """Opens the on-disk entity store at `path` (a directory), if it is not already open."""
+        with cls.LOCK:
+            if cls.STORE is None:
+                cls.STORE = SegmentStore(path)
+        return cls()
+
+    @classmethod
+    def close(cls):
+        with cls.LOCK:
+            if cls.STORE is not None:
+                cls.STORE.close()
+                cls.STORE = None
+
+    def entities(self, sentence: str) -> dict:
+        """Performs NER and SRL analysis of the given sentence, using the models from
+        `Combining Formal and Machine Learning Techniques for the Generation of JML Specifications`.
+        Output is a dictionary, containing keys "ner" and "srl", corresponding to the NER and SRL entities,
+        respectively. The items are formatted as either a dictionary or list of dictionaries for spaCy display.
+
+        Concurrent calls for the same sentence share a single request to the NER and SRL services,
+        and results are persisted to the on-disk entity store, if one is open."""
+        return self.entities_many([sentence])[0]
+
+    def entities_many(self, sentences: List[str]) -> List[dict]:
+        """Performs `entities` for each of the given sentences, requesting analysis of all sentences
+        which are not cached, or already being requested by another caller, concurrently."""
+        normalized = [
+            unidecode.unidecode(sentence).rstrip(".") for sentence in sentences
+        ]
+        results = {}
+        owned: Dict[str, Future] = {}
+        waiting: Dict[str, Future] = {}
+        for sentence in dict.fromkeys(normalized):
+            cached = self.cache.get(sentence)
+            if cached is not None:
+                results[sentence] = cached
+                continue
+
+            with EntityAnalyzer.LOCK:
+                if sentence in self.cache:
+                    results[sentence] = self.cache[sentence]
+                elif sentence in self.inflight:
+                    waiting[sentence] = self.inflight[sentence]
+                else:
+                    owned[sentence] = self.inflight[sentence] = Future()
+
+        try:
+            results.update(self._load_entities(list(owned)))
+            for sentence, future in owned.items():
+                self.cache[sentence] = results[sentence]
+                future.set_result(results[sentence])
+        except Exception as e:
+            for future in owned.values():
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        finally:
+            with EntityAnalyzer.LOCK:
+                for sentence in owned:
+                    del self.inflight[sentence]
+
+        for sentence, future in waiting.items():
+            results[sentence] = future.result()
+
+        return [results[sentence] for sentence in normalized]
+
+    def _load_entities(self, sentences: List[str]) -> Dict[str, dict]:
+        """Reads the entities of each sentence from the entity store, requesting the remaining
+        sentences from the NER and SRL services."""
+        loaded = {}
+        missing = []
+        for sentence in sentences:
+            record = None
+            if self.store is not None:
+                record = self.store.get(sentence_key(sentence))
+            if record is not None:
+                self.cache.store_hit()
+                loaded[sentence] = json.loads(record)
+            else:
+                missing.append(sentence)
+
+        if not missing:
+            return loaded
+
+        try:
+            for sentence, res in zip(missing, ner_and_srl_many(missing)):
+                entities = loaded[sentence] = spacy_entities(sentence, res)
+                if self.store is not None:
+                    key = sentence_key(sentence)
+                    self.store.put(key, json.dumps(entities).encode("utf-8"))
+        finally:
+            # Results converted before a malformed response are kept
+            if self.store is not None:
+                self.store.flush()
+        return loaded
 
 
 def print_ner_and_srl(text: str, srl_url=SRL_URL, ner_url=NER_URL):
@@ -35,8 +314,10 @@ def print_ner_and_srl(text: str, srl_url=SRL_URL, ner_url=NER_URL):
 
 if __name__ == "__main__":
     sentences = [
-        "Removes and returns the element at position index within the vector, shifting all elements after it to the left.",
-        "Removes the last element from a vector and returns it, or None if it is empty.",
+        "Removes and returns the element at position index within the vector, "
+        "shifting all elements after it to the left.",
+        "Removes the last element from a vector and returns it, "
+        "or None if it is empty.",
         "whichptr indicates which xbuffer holds the final iMCU row.",
     ]
     # "Removes [element index] vector"
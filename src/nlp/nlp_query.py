@@ -1,16 +1,21 @@
-import itertools
-import re
-from typing import Collection, List
+import logging
+import threading
+from bisect import bisect_right
+from collections import defaultdict
+from functools import lru_cache
+from typing import (Collection, Dict, FrozenSet, Iterable, Iterator, List,
+                    NamedTuple, Optional, Sequence, Set, Tuple)
 
 try:
-    from tokenizer import Tokenizer
+    from tokenizer import Sentence, Tokenizer
 except ImportError:
-    from nlp.tokenizer import Tokenizer
+    from nlp.tokenizer import Sentence, Tokenizer
 
+LOGGER = logging.getLogger(__name__)
 
-def peek(it):
-    first = next(it)
-    return first, itertools.chain([first], it)
+# WordNet part of speech of each coarse tag (see `coarse_tag`)
+WORDNET_POS = {"NN": "n", "VB": "v", "JJ": "a", "RB": "r"}
+SYNONYM_CACHE_SIZE = 4096
 
 
 def tags_similar(tag1: str, tag2: str) -> bool:
@@ -23,24 +28,62 @@ def tags_similar(tag1: str, tag2: str) -> bool:
     return False
 
 
+def similar_class(tag: str) -> str:
+    """Groups tags such that `tags_similar(a, b)` holds exactly when `similar_class(a) == similar_class(b)`."""
+    if tag.startswith("NN"):
+        return "NN"
+    if tag.startswith("VB"):
+        return "VB"
+    return tag
+
+
 def is_one_of(tag: str, choices: Collection[str]) -> bool:
     return any(choice in tag for choice in choices)
 
 
-def get_regex_for_tag(tag: str) -> str:
-    if "VB" in tag:
-        return "VB(D|G|N|P|Z)?"
-    if "NN" in tag:
-        return "NN(P|PS|S)?"
-    if "RB" in tag:
-        return "RB(R|S)?"
-    if "JJ" in tag:
-        return "JJ(R|S)?"
+def coarse_tag(tag: str) -> str:
+    """Groups tags coarsely, eg. all verb tags are grouped under VB. Every pair of similar tags (see
+    `tags_similar`) shares a coarse tag."""
+    for prefix in ("VB", "NN", "RB", "JJ"):
+        if prefix in tag:
+            return prefix
     if is_one_of(tag, {"CODE", "LIT"}):
-        return "(CODE|LIT)"
+        return "CODE"
     return tag
 
 
+@lru_cache(maxsize=None)
+def wordnet_corpus():
+    """Returns NLTK's WordNet corpus reader, or None if NLTK or the corpus is not installed."""
+    try:
+        from nltk.corpus import wordnet
+
+        wordnet.ensure_loaded()
+    except (ModuleNotFoundError, LookupError):
+        LOGGER.warning("WordNet is unavailable, so query words will not match synonyms")
+        return None
+    return wordnet
+
+
+@lru_cache(maxsize=SYNONYM_CACHE_SIZE)
+def lookup_synonyms(lemma: str, tag: str) -> FrozenSet[str]:
+    """Returns the lemmas of the WordNet synsets of `lemma` with the part of speech of `tag`, lowercased,
+    with multi-word lemmas joined by spaces. Empty if WordNet is unavailable."""
+    pos = WORDNET_POS.get(coarse_tag(tag))
+    wn = wordnet_corpus()
+    if pos is None or wn is None:
+        return frozenset()
+    return frozenset(
+        name.lower().replace("_", " ")
+        for synset in wn.synsets(lemma, pos=pos)
+        for name in synset.lemma_names()
+    )
+
+
+def is_synonym(word: str, other: str, tag: str) -> bool:
+    return other.lower() in lookup_synonyms(word.lower(), tag)
+
+
 class Word:
     EVAL_COST = 1e-3
 
@@ -51,99 +94,377 @@ class Word:
         allow_synonyms: bool,
         is_optional: bool,
         lemma: str = None,
+        synonyms: Optional[FrozenSet[str]] = None,
     ):
         self.allow_synonyms = allow_synonyms
         self.word = word
         self.tag = tag
         self.is_optional = is_optional
         self.lemma = lemma
+        if synonyms is None:
+            synonyms = frozenset()
+            if allow_synonyms:
+                synonyms = lookup_synonyms((lemma or word).lower(), tag)
+        self.synonyms = synonyms
+
+    def lemmas(self) -> FrozenSet[str]:
+        """The lemmas of tokens which this word matches."""
+        if self.allow_synonyms:
+            return self.synonyms | {self.lemma}
+        return frozenset({self.lemma})
 
     def __str__(self):
         return self.word
 
 
+class PhraseAutomaton:
+    """Compiles phrases into a single NFA over the tag and lemma of each token, which is run over
+    a sentence's (tag, text, lemma) tokens in one pass, and reports every phrase matching the sentence.
+
+    A phrase of n words has states 0..n, where state i has matched the first i words, and state n accepts.
+    The states of every phrase are packed into the bits of one integer, so that the set of active states
+    is stepped with a few integer operations per token: a new match may start at each token, the states
+    whose word matches the token advance by one bit, and optional words may be skipped. A word matches a
+    token with a similar tag (see `similar_class`) and one of its lemmas (see `Word.lemmas`) - as synonyms are
+    expanded when the word is created, each token's matching words are found with a single lookup.
+    """
+
+    def __init__(self, phrases: Sequence["Phrase"]):
+        self.phrases = phrases
+        # Bits of the start states, the words which may be skipped, and the accepting states
+        self.starts = 0
+        self.optional = 0
+        self.accepts = 0
+        # Accepting state bit -> phrase index
+        self.accept_bits: List[Tuple[int, int]] = []
+        # (similar class, lemma) -> bits of the words matching tokens with that class and lemma
+        self.lemma_bits: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.class_cache: Dict[str, str] = {}
+
+        offset = 0
+        for i, phrase in enumerate(phrases):
+            self.starts |= 1 << offset
+            for j, word in enumerate(phrase.phrase):
+                bit = 1 << (offset + j)
+                if word.is_optional:
+                    self.optional |= bit
+                tag_class = similar_class(word.tag)
+                for lemma in word.lemmas():
+                    self.lemma_bits[(tag_class, lemma)] |= bit
+            accept = 1 << (offset + len(phrase.phrase))
+            self.accepts |= accept
+            self.accept_bits.append((accept, i))
+            offset += len(phrase.phrase) + 1
+
+    def _skip_optional(self, active: int) -> int:
+        while True:
+            skipped = active | ((active & self.optional) << 1)
+            if skipped == active:
+                return active
+            active = skipped
+
+    def token_bits(self, tag: str, lemma: str) -> int:
+        """Returns the bits of the words which match the token."""
+        tag_class = self.class_cache.get(tag)
+        if tag_class is None:
+            tag_class = self.class_cache[tag] = similar_class(tag)
+        return self.lemma_bits.get((tag_class, lemma), 0)
+
+    def run(self, tokens: Iterable[Tuple[str, str, str]]) -> Set[int]:
+        """Returns the indices of the phrases which match the tokens."""
+        accepted = 0
+        active = 0
+        for tag, _, lemma in tokens:
+            active = self._skip_optional(active | self.starts)
+            accepted |= active & self.accepts
+            if accepted == self.accepts:
+                break
+            active = (active & self.token_bits(tag, lemma)) << 1
+        else:
+            active = self._skip_optional(active | self.starts)
+            accepted |= active & self.accepts
+        return {i for bit, i in self.accept_bits if accepted & bit}
+
+
 class Phrase:
     EVAL_COST = 1.0
 
     def __init__(self, phrase: List[Word], tokenizer: Tokenizer):
         self.tokenizer = tokenizer
         self.phrase = phrase
-        regex_str = ""
-        for word in self.phrase:
-            val = get_regex_for_tag(re.escape(word.tag))
-            if word.is_optional:
-                regex_str += f"({val} )?"
-            else:
-                regex_str += f"{val} "
-
-        regex_str = regex_str[:-1]
-        self.tag_regex = re.compile(regex_str)
-        self.regex_str = regex_str
+        self.automaton = PhraseAutomaton([self])
+
+    def matches_tokens(self, tokens: Sequence[Tuple[str, str, str]]) -> bool:
+        """Determines whether the phrase matches the tokenized sentence, given as the (tag, text, lemma)
+        of each token (eg. `Sentence.metadata`)."""
+        return bool(self.automaton.run(tokens))
+
+    def key(self) -> tuple:
+        """Phrases with equal keys match the same sentences."""
+        return tuple(
+            (similar_class(word.tag), word.lemmas(), word.is_optional)
+            for word in self.phrase
+        )
 
     def matches(self, item):
         """Determines whether the phrase matches the provided fn.
         To match the phrase, the function must contain all non-optional words, in sequence, with no gaps.
         Words do not need to have matching tenses or forms to be considered equal (using NLTK's lemmatizer).
         """
-
-        def split_str(s: str, index: int):
-            return s[:index], s[index:]
-
         docs = item.docs.sections()
-        if isinstance(item, Fn):
-            idents = {ty.ident for ty in item.inputs}
-        else:
-            idents = None
-
         if docs:
             for sentx in docs[0].sentences:
-                sent = self.tokenizer.tokenize(sentx)
-                s = " ".join(token.tag_ for token in sent.doc)
-                for match in self.tag_regex.finditer(s):
-                    prev, curr = split_str(s, match.start(0))
-                    curr, after = split_str(curr, match.end(0) - match.start(0))
-
-                    match_len = curr.count(" ") + 1
-                    match_start = prev.count(" ")
-
-                    match_tokens = sent.doc[match_start : match_start + match_len]
-                    word_iter = iter(match_tokens)
-                    matches = True
-                    for word in self.phrase:
-                        match, word_iter = peek(word_iter)
-                        if tags_similar(word.tag, match.tag_):
-                            next(word_iter)
-                            if word.lemma == match.lemma_:
-                                continue
-                            elif word.allow_synonyms:
-                                if not is_synonym(word.word, match.text, word.tag):
-                                    matches = False
-                                    break
-                            else:
-                                matches = False
-                                break
-                        elif word.is_optional:
-                            continue
-                        else:
-                            matches = False
-                            break
-                    if matches:
-                        return True
+                if self.matches_tokens(self.tokenizer.tokenize(sentx).metadata):
+                    return True
         return False
 
     def __str__(self):
         return " ".join(str(x) for x in self.phrase)
 
 
-def query_from_sentence(sentence, tokenizer: Tokenizer, *args, **kwargs) -> "Query":
+class Query:
+    """Matches items whose docs match every phrase. Phrases may match different sentences."""
+
+    def __init__(self, phrases: List[Phrase]):
+        self.phrases = phrases
+        self.automaton = PhraseAutomaton(phrases)
+
+    def matches(self, item) -> bool:
+        if not self.phrases:
+            return True
+        docs = item.docs.sections()
+        if not docs:
+            return False
+        tokenizer = self.phrases[0].tokenizer
+        matched: Set[int] = set()
+        for sentx in docs[0].sentences:
+            matched |= self.automaton.run(tokenizer.tokenize(sentx).metadata)
+            if len(matched) == len(self.phrases):
+                return True
+        return False
+
+    def __str__(self):
+        return " | ".join(str(phrase) for phrase in self.phrases)
+
+
+# (tag, text, lemma) of each token in a sentence
+Tokens = Tuple[Tuple[str, str, str], ...]
+
+
+class SearchMatch(NamedTuple):
+    path: str
+    # Number of sentences in the item's docs matching each of the query's phrases, summed
+    score: int
+
+
+class CorpusIndex:
+    """An inverted index over the tokenized doc sentences of a corpus of items, identified by path.
+
+    Each sentence is posted under the coarse tag (see `coarse_tag`) of each of its tokens, and under the
+    (coarse tag, lemma) of each token, along with the token's positions. A phrase's candidate sentences are
+    found by intersecting the postings of its required words - only sentences which contain every required
+    word, in order, are checked with `Phrase.matches_tokens`.
+
+    Items may be added while the index is searched, eg. by concurrent requests to the server.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self.tokenizer = tokenizer
+        self.paths: List[str] = []
+        # (item id, tokens) of each sentence
+        self.sentences: List[Tuple[int, Tokens]] = []
+        # coarse tag -> sentence id -> positions
+        self.tag_postings: Dict[str, Dict[int, List[int]]] = defaultdict(dict)
+        # (coarse tag, lemma) -> sentence id -> positions
+        self.lemma_postings: Dict[Tuple[str, str], Dict[int, List[int]]]
+        self.lemma_postings = defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add_items(self, items: Iterable[Tuple[str, List[str]]]):
+        """Adds the (path, doc sentences) of each item to the index, tokenizing all sentences at once."""
+        items = list(items)
+        sentences = [sentence for _, sents in items for sentence in sents]
+        tokenized = iter(
+            [
+                tuple(sent.metadata)
+                for sent in self.tokenizer.stream_tokenize(sentences)
+            ]
+        )
+        with self.lock:
+            for path, sents in items:
+                item_id = len(self.paths)
+                self.paths.append(path)
+                for _ in sents:
+                    self._add_sentence(item_id, next(tokenized))
+
+    def add(self, path: str, sentences: List[str]):
+        self.add_items([(path, sentences)])
+
+    def _add_sentence(self, item_id: int, tokens: Tokens):
+        sentence_id = len(self.sentences)
+        self.sentences.append((item_id, tokens))
+        for pos, (tag, _, lemma) in enumerate(tokens):
+            coarse = coarse_tag(tag)
+            self.tag_postings[coarse].setdefault(sentence_id, []).append(pos)
+            self.lemma_postings[(coarse, lemma)].setdefault(sentence_id, []).append(pos)
+
+    def _postings(self, word: Word) -> Dict[int, List[int]]:
+        coarse = coarse_tag(word.tag)
+        if word.allow_synonyms:
+            return self.tag_postings.get(coarse, {})
+        return self.lemma_postings.get((coarse, word.lemma), {})
+
+    def candidates(self, phrase: Phrase) -> Iterable[int]:
+        """Produces the ids of sentences which contain each required word of the phrase, in order."""
+        required = [
+            self._postings(word) for word in phrase.phrase if not word.is_optional
+        ]
+        if not required:
+            return range(len(self.sentences))
+
+        sentence_ids = set(min(required, key=len))
+        for postings in required:
+            sentence_ids.intersection_update(postings)
+
+        def in_order(sentence_id: int) -> bool:
+            pos = -1
+            for postings in required:
+                positions = postings[sentence_id]
+                i = bisect_right(positions, pos)
+                if i == len(positions):
+                    return False
+                pos = positions[i]
+            return True
+
+        return sorted(filter(in_order, sentence_ids))
+
+    def search_phrase(self, phrase: Phrase) -> Set[int]:
+        """Returns the ids of the items with a sentence matching the phrase."""
+        items = set()
+        for sentence_id in self.candidates(phrase):
+            item_id, tokens = self.sentences[sentence_id]
+            if item_id not in items and phrase.matches_tokens(tokens):
+                items.add(item_id)
+        return items
+
+    def search(self, query: Query) -> List[str]:
+        """Returns the paths of the items matching the query, in the order they were added."""
+        with self.lock:
+            items: Optional[Set[int]] = None
+            for phrase in query.phrases:
+                matched = self.search_phrase(phrase)
+                items = matched if items is None else items & matched
+                if not items:
+                    return []
+            if items is None:
+                return []
+            return [self.paths[item_id] for item_id in sorted(items)]
+
+    def search_many(self, queries: Sequence[Query]) -> List[List[SearchMatch]]:
+        """Searches for all of the queries in one scan of the index. The phrases of every query are run as
+        one automaton over the union of their candidate sentences, and equal phrases are only evaluated once.
+
+        Returns the items matching each query, ranked by score (see `SearchMatch`), then in the order they
+        were added.
+        """
+        phrases: List[Phrase] = []
+        phrase_ids: Dict[tuple, int] = {}
+        query_phrase_ids: List[Set[int]] = []
+        for query in queries:
+            ids = set()
+            for phrase in query.phrases:
+                key = phrase.key()
+                if key not in phrase_ids:
+                    phrase_ids[key] = len(phrases)
+                    phrases.append(phrase)
+                ids.add(phrase_ids[key])
+            query_phrase_ids.append(ids)
+
+        automaton = PhraseAutomaton(phrases)
+        # item id -> phrase id -> number of matching sentences
+        counts: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        with self.lock:
+            sentence_ids: Set[int] = set()
+            for phrase in phrases:
+                sentence_ids.update(self.candidates(phrase))
+
+            for sentence_id in sorted(sentence_ids):
+                item_id, tokens = self.sentences[sentence_id]
+                for phrase_id in automaton.run(tokens):
+                    counts[item_id][phrase_id] += 1
+
+        results = []
+        for ids in query_phrase_ids:
+            matches = [
+                (item_id, sum(phrase_counts[i] for i in ids))
+                for item_id, phrase_counts in counts.items()
+                if ids and ids.issubset(phrase_counts)
+            ]
+            matches.sort(key=lambda match: (-match[1], match[0]))
+            results.append(
+                [SearchMatch(self.paths[item_id], score) for item_id, score in matches]
+            )
+        return results
+
+    def iter_matches(self, query: Query) -> Iterator[SearchMatch]:
+        """Produces the items matching the query as they are found, in the order they were added, without
+        ranking them. Candidate sentences are found under the lock, but scanned without holding it, so that
+        items can be added while matches are consumed (eg. streamed to a slow client)."""
+        if not query.phrases:
+            return
+        with self.lock:
+            sentence_ids: Set[int] = set()
+            for phrase in query.phrases:
+                sentence_ids.update(self.candidates(phrase))
+
+        # An item's sentences are added together, so its matches are complete once a later item is reached
+        current = None
+        counts: Dict[int, int] = defaultdict(int)
+        for sentence_id in sorted(sentence_ids):
+            # Sentences are only appended, so existing ids remain valid without the lock
+            item_id, tokens = self.sentences[sentence_id]
+            if item_id != current:
+                if len(counts) == len(query.phrases):
+                    yield SearchMatch(self.paths[current], sum(counts.values()))
+                current = item_id
+                counts.clear()
+            for phrase_id in query.automaton.run(tokens):
+                counts[phrase_id] += 1
+        if len(counts) == len(query.phrases):
+            yield SearchMatch(self.paths[current], sum(counts.values()))
+
+    def search_sentences(self, sentences: List[str]) -> List[List[SearchMatch]]:
+        """Forms a query from each sentence (see `query_from_sentence`), and searches for all of them at once."""
+        return self.search_many(queries_from_sentences(sentences, self.tokenizer))
+
+
+def query_from_sentence(sentence, tokenizer: Tokenizer, *args, **kwargs) -> Query:
     """Forms a query from a sentence.
 
     Stopwords (per Wordnet's stopwords), and words which are not verbs, nouns, adverbs, or adjectives, are all removed.
     Adverbs and adjectives are optional, and can be substituted with synonyms.
+    Query sentences are not added to the token cache, store, or vector index.
     """
-    phrases = [[]]
+    return query_from_tokens(
+        tokenizer.tag_uncached(sentence), tokenizer, *args, **kwargs
+    )
 
-    sent = tokenizer.tokenize(sentence)
+
+def queries_from_sentences(sentences: List[str], tokenizer: Tokenizer) -> List[Query]:
+    """Forms a query from each sentence, tagging all of the sentences at once. As in
+    `query_from_sentence`, query sentences are not kept."""
+    return [
+        query_from_tokens(sent, tokenizer)
+        for sent in tokenizer.tag_uncached_many(sentences)
+    ]
+
+
+def query_from_tokens(sent: Sentence, tokenizer: Tokenizer, *args, **kwargs) -> Query:
+    """Forms a query from a tokenized sentence, as in `query_from_sentence`."""
+    phrases = [[]]
 
     for token in sent.doc:
         if token.is_stop or token.tag_ in {"CODE", "LIT"}:
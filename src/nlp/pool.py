@@ -0,0 +1,122 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, List, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# The tokenizer loaded in each worker process
+WORKER_TOKENIZER = None
+
+
+def init_worker(model, profile):
+    global WORKER_TOKENIZER
+    try:
+        from tokenizer import Tokenizer
+    except ModuleNotFoundError:
+        from .tokenizer import Tokenizer
+
+    WORKER_TOKENIZER = Tokenizer(model, profile)
+
+
+def tag_chunk(sentences: List[str]) -> List[Tuple[bytes, bytes]]:
+    return list(WORKER_TOKENIZER.tag_records(sentences))
+
+
+def warm_up_chunk(sentences: List[str]) -> int:
+    """Tags the sentences, returning the pid of the worker which tagged them."""
+    tag_chunk(sentences)
+    return os.getpid()
+
+
+class TaggerPool:
+    """Tags sentences in a pool of worker processes, each of which loads its own copy of the model.
+    Sentences are split into chunks of `chunk_size`, so that a single large request is spread over
+    all workers, and chunks from concurrent requests are tagged in parallel.
+
+    Workers only tag sentences - results are returned as (msgpack payload, serialized Doc) records,
+    and the calling process remains the only writer to the token cache and on-disk store.
+
+    If a worker dies (eg. it is killed for running out of memory), the executor is broken - it is replaced
+    with a new one, and each affected chunk is retried once.
+    """
+
+    def __init__(self, model, profile, workers: int, chunk_size: int = 64):
+        self.model = model
+        self.profile = profile
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        LOGGER.info(f"Starting {workers} tagging workers for spacy/{model} ({profile})")
+        self.executor = self._start_executor()
+
+    def _start_executor(self) -> ProcessPoolExecutor:
+        # Workers are spawned rather than forked, so that they do not inherit the server's
+        # threads, open stores and memory maps.
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(self.model, self.profile),
+        )
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        """Replaces the executor, unless another thread has already replaced it."""
+        with self.lock:
+            if self.executor is not broken:
+                return
+            LOGGER.warning(
+                f"A tagging worker for spacy/{self.model} ({self.profile}) died, restarting workers"
+            )
+            self.executor = self._start_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, chunk: List[str]) -> Tuple[ProcessPoolExecutor, Future]:
+        """Submits the chunk, returning the executor which runs it along with its future."""
+        executor = self.executor
+        try:
+            return executor, executor.submit(tag_chunk, chunk)
+        except BrokenProcessPool:
+            self._restart(executor)
+            executor = self.executor
+            return executor, executor.submit(tag_chunk, chunk)
+
+    def tag(self, sentences: List[str]) -> Iterable[Tuple[bytes, bytes]]:
+        """Produces a (msgpack payload, serialized Doc) record for each sentence, in order."""
+        chunks = [
+            sentences[i : i + self.chunk_size]
+            for i in range(0, len(sentences), self.chunk_size)
+        ]
+        submitted = [self._submit(chunk) for chunk in chunks]
+        try:
+            for i, chunk in enumerate(chunks):
+                executor, future = submitted[i]
+                try:
+                    records = future.result()
+                except BrokenProcessPool:
+                    self._restart(executor)
+                    submitted[i] = self._submit(chunk)
+                    records = submitted[i][1].result()
+                yield from records
+        finally:
+            for _, future in submitted:
+                future.cancel()
+
+    def warm_up(self, sentences: List[str]):
+        """Tags the sentences in every worker, so that the first request does not wait for workers to
+        start and load the model. The executor only starts a worker when a chunk is submitted and no worker
+        is idle, and a warm worker may take several chunks - chunks are submitted until each worker has
+        answered."""
+        pids = set()
+        while len(pids) < self.workers:
+            futures = [
+                self.executor.submit(warm_up_chunk, sentences)
+                for _ in range(self.workers - len(pids))
+            ]
+            pids.update(future.result() for future in futures)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
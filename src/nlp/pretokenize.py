@@ -0,0 +1,98 @@
+# Splits out code spans, string and char literals, boolean operators and Rust numeric literals
+# as single tokens before spaCy's tokenizer runs, so that `fix_tokens` does not have to merge
+# them back together, and the tagger processes fewer tokens.
+
+import re
+from typing import Callable, List, Optional
+
+from spacy.tokens import Doc
+
+# Each alternative mirrors a merge or literal rule in fix_tokens.py. Alternatives are tried in order
+# at each position, so backticks and quotes inside of a code span are part of the code span.
+# Literals are only matched as whole space-separated chunks, optionally between opening and closing
+# punctuation (eg. `(5`, `2u32,`, `3.5f32.`), so that a literal is tokenized the same way whether or
+# not punctuation follows it. Elsewhere (eg. `1,000`, `1.2.3`, `3-4`), spaCy's tokenizer decides where
+# they end.
+PRETOKEN_REGEX = re.compile(
+    r"""
+    (?P<CODE>`[^`]+`)
+    | (?P<STR>"[^"]*")
+    | (?P<CHAR>(?<![\w'])'[!-~]')
+    | (?P<BOOL_OP>==|!=|&&|\|\|)
+    | (?P<LIT>
+        (?<![^ (\[])-?\d(?:_?\d)*
+        (?:\.\d(?:_?\d)*)?
+        (?:e[-+]?\d(?:_?\d)*)?
+        (?:[iu](?:8|16|32|64|128|size)|f32|f64)?
+        (?=[,.;:!?)\]]*(?![^ ]))
+    )
+    """,
+    re.VERBOSE,
+)
+
+# Literals are only kept whole here - they are tagged by the LIT word rules, in order.
+TAGGED_GROUPS = {"CODE", "STR", "CHAR", "BOOL_OP"}
+
+
+def pretoken_tag(text: str) -> Optional[str]:
+    """Returns the tag of a token produced by `CodeTokenizer`, if it is a code span, string,
+    char literal or boolean operator."""
+    if not text or text[0] not in "`\"'=!&|":
+        return None
+    match = PRETOKEN_REGEX.fullmatch(text)
+    if match is None or match.lastgroup not in TAGGED_GROUPS:
+        return None
+    return match.lastgroup
+
+
+class CodeTokenizer:
+    """Wraps a spaCy tokenizer, emitting each match of PRETOKEN_REGEX as a single token, and
+    tokenizing the text between matches with the wrapped tokenizer.
+
+    spaCy tokenizes each space-separated chunk of text as a whole - eg. `b.` is kept as an abbreviation,
+    but `a!=b.` ends in `b` and `.`. So the text between two matches is tokenized along with the rest of
+    the chunks it shares with the matches, and only the tokens within it are kept."""
+
+    def __init__(self, tokenizer: Callable[[str], Doc]):
+        # The wrapped tokenizer, which also produces spaCy's own tokenization of a text
+        self.base = tokenizer
+        self.vocab = tokenizer.vocab
+
+    def __call__(self, text: str) -> Doc:
+        matches = list(PRETOKEN_REGEX.finditer(text))
+        if not matches:
+            return self.base(text)
+
+        words: List[str] = []
+        spaces: List[bool] = []
+        end = 0
+        for match in matches:
+            self._tokenize_gap(text, end, match.start(), words, spaces)
+            words.append(match.group())
+            spaces.append(False)
+            end = match.end()
+        self._tokenize_gap(text, end, len(text), words, spaces)
+
+        return Doc(self.vocab, words=words, spaces=spaces)
+
+    def _tokenize_gap(
+        self, text: str, start: int, end: int, words: List[str], spaces: List[bool]
+    ):
+        # A single space after a token belongs to that token, as in spaCy's tokenizer
+        if words and text.startswith(" ", start, end):
+            spaces[-1] = True
+            start += 1
+        if start >= end:
+            return
+        context_start = text.rfind(" ", 0, start) + 1
+        context_end = text.find(" ", end)
+        if context_end < 0:
+            context_end = len(text)
+        for token in self.base(text[context_start:context_end]):
+            token_start = context_start + token.idx
+            token_end = token_start + len(token)
+            if token_end <= start or token_start >= end:
+                continue
+            # A token which crosses into a match is cut at the match, so no text is lost
+            words.append(text[max(token_start, start) : min(token_end, end)])
+            spaces.append(bool(token.whitespace_) and token_end < end)
@@ -0,0 +1,67 @@
+import logging
+import threading
+from typing import Dict, List, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+def installed_model_info(pkg_name: str) -> dict:
+    from spacy import about
+    from spacy.util import (get_model_meta, get_package_path,
+                            get_package_version, is_compatible_version)
+
+    package = pkg_name.replace("-", "_")
+    model_meta = get_model_meta(get_package_path(package))
+    spacy_version = model_meta.get("spacy_version", "n/a")
+    return {
+        "name": package,
+        "version": get_package_version(pkg_name),
+        "spacy": spacy_version,
+        # Models declare the range of spaCy versions they support, so compatibility is checked
+        # locally rather than against spaCy's published compatibility table
+        "compat": bool(is_compatible_version(about.__version__, spacy_version)),
+        "lang": model_meta.get("lang"),
+        # As in `Tokenizer.from_cache`, which checks the width of the loaded vocab's vectors
+        "has_vec": (model_meta.get("vectors") or {}).get("width", 0) > 0,
+        "meta": model_meta,
+    }
+
+
+class ModelRegistry:
+    """Holds the metadata of each installed spaCy model. Installed packages are only inspected
+    by `refresh`, so that lookups are answered from memory, and do not need network access."""
+
+    def __init__(self):
+        self.models: Dict[str, dict] = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def refresh(self) -> Dict[str, dict]:
+        from spacy.util import get_installed_models
+
+        models = {}
+        for pkg_name in get_installed_models():
+            try:
+                models[pkg_name] = installed_model_info(pkg_name)
+            except Exception:
+                LOGGER.exception(f"Failed to read metadata of {pkg_name}")
+
+        with self.lock:
+            self.models = models
+            self.loaded = True
+        LOGGER.info(f"Found {len(models)} installed spaCy models")
+        return models
+
+    def find(self, lang: str = "en", has_vec: Optional[bool] = None) -> List[str]:
+        """Returns the names of compatible models for the given language, optionally filtering
+        for models which do (or do not) have word vectors."""
+        if not self.loaded:
+            self.refresh()
+
+        return [
+            name
+            for name, data in self.models.items()
+            if data["lang"] == lang
+            and data["compat"]
+            and (has_vec is None or data["has_vec"] == has_vec)
+        ]
@@ -0,0 +1,120 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """Coalesces sentences submitted by concurrent callers into batches for a single tagging call.
+
+    A batch is started as soon as a sentence is submitted, and is sent to `tag` once it holds `max_batch`
+    sentences, or once `max_wait` seconds have passed. Sentences which are already pending share the same
+    future, so each distinct sentence is tagged at most once while in flight. Futures are
+    `concurrent.futures.Future`s, which async callers can await using `asyncio.wrap_future`.
+
+    Up to `concurrency` batches are tagged at once, so that a pool of workers is kept busy. The next batch
+    only starts collecting sentences once one of these slots is free, so sentences arriving while all
+    batches are in flight are coalesced rather than tagged one small batch at a time.
+    """
+
+    def __init__(
+        self,
+        tag: Callable[[List[str]], Iterable],
+        max_batch: int = 256,
+        max_wait: float = 0.002,
+        name: str = "tagger",
+        concurrency: int = 1,
+    ):
+        self.tag = tag
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.SimpleQueue()
+        self.pending: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.sentences = 0
+        self.slots = threading.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix=f"batch-{name}"
+        )
+        self.thread = threading.Thread(
+            target=self._run, name=f"batch-{name}", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, sentences: List[str]) -> List[Future]:
+        """Queues the sentences for tagging, returning one future per sentence."""
+        futures = []
+        with self.lock:
+            for sentence in sentences:
+                future = self.pending.get(sentence)
+                if future is None:
+                    future = self.pending[sentence] = Future()
+                    self.queue.put(sentence)
+                futures.append(future)
+        return futures
+
+    def _next_batch(self) -> List[str]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=max(timeout, 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self.slots.acquire()
+            batch = self._next_batch()
+            if None in batch:
+                batch = [sentence for sentence in batch if sentence is not None]
+                self.executor.submit(self._run_batch, batch)
+                break
+            self.executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: List[str]):
+        try:
+            self._tag_batch(batch)
+        finally:
+            self.slots.release()
+
+    def _tag_batch(self, batch: List[str]):
+        if not batch:
+            return
+        with self.lock:
+            self.batches += 1
+            self.sentences += len(batch)
+        done = 0
+        try:
+            for sentence, result in zip(batch, self.tag(batch)):
+                with self.lock:
+                    future = self.pending.pop(sentence)
+                future.set_result(result)
+                done += 1
+            if done != len(batch):
+                raise RuntimeError(f"Tagged {done} of {len(batch)} sentences")
+        except Exception as e:
+            LOGGER.exception("Tagging batch failed")
+            with self.lock:
+                futures = [self.pending.pop(sentence) for sentence in batch[done:]]
+            for future in futures:
+                future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "sentences": self.sentences,
+            "pending": len(self.pending),
+        }
+
+    def shutdown(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
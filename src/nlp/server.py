@@ -1,18 +1,27 @@
+import json
 import logging
+import threading
 import time
 from contextlib import contextmanager
 from http import HTTPStatus
 from io import BytesIO
 from os import getenv
-from typing import List, Optional
+from typing import Dict, List, Optional
 
+import msgpack
 import spacy
 from fastapi import FastAPI, Header, HTTPException, Query, Response
 from pydantic import BaseModel
 from starlette.responses import HTMLResponse, JSONResponse, StreamingResponse
 
-from tokenizer import SpacyModel, Tokenizer
+from ner import EntityAnalyzer, NLPError, close_service_client
+from nlp_query import CorpusIndex
+from nlp_query import Query as SearchQuery
+from nlp_query import query_from_tokens
+from registry import ModelRegistry
+from tokenizer import PipelineProfile, SpacyModel, Tokenizer, cache_path
 from visualization import router
+from warmup import LoadState, Warmup, preload_models
 
 REF_TEMPLATE = "#/components/schemas/{model}"
 logger = logging.getLogger("specifiernlp")
@@ -20,6 +29,11 @@ logger.setLevel(logging.INFO)
 
 app = FastAPI(docs_url=None, redoc_url=None, debug=getenv("DEBUG_SERVER", True))
 app.include_router(router)
+WARMUP = Warmup(preload_models())
+REGISTRY = ModelRegistry()
+# Documentation corpora searched by `/search`, keyed by name
+CORPORA: Dict[str, CorpusIndex] = {}
+CORPORA_LOCK = threading.Lock()
 
 
 def write_array_len(data: BytesIO, arr_len):
@@ -45,6 +59,8 @@ def timer(fstring):
 class TokenizeIn(BaseModel):
     model: SpacyModel = SpacyModel.EN_SM
     sentences: List[str]
+    # Defaults to PIPELINE_PROFILE
+    profile: Optional[PipelineProfile] = None
 
 
 class Token(BaseModel):
@@ -71,22 +87,34 @@ TOKENIZE_OUT = {
             "application/json": {
                 "schema": TokenizeOut.schema(ref_template=REF_TEMPLATE),
             },
+            "application/x-ndjson": {
+                "schema": SentenceOut.schema(ref_template=REF_TEMPLATE),
+            },
         },
     }
 }
+TOKENIZE_ACCEPT = {"application/msgpack", "application/json", "application/x-ndjson"}
 
 
-async def streaming_sentences(num_sentences, sentences):
+def streaming_sentences(num_sentences, payloads):
+    """Streams the msgpack encoding of {"sentences": [...]}, yielding each sentence's payload as soon as
+    it is produced. This is a sync generator, so that Starlette runs tagging in its threadpool."""
     header = BytesIO()
     header.write(b"\x81")
     header.write((0x5 << 5 | len("sentences")).to_bytes(1, byteorder="big"))
     header.write(b"sentences")
     write_array_len(header, num_sentences)
-    header.seek(0)
-    yield header.read()
+    yield header.getvalue()
+
+    with timer("Streaming tokenization took {elapsed:.5f}s"):
+        yield from payloads
 
-    for sentence in sentences:
-        yield sentence.msgpack
+
+def streaming_ndjson(sentences):
+    """Streams one JSON-encoded sentence per line."""
+    with timer("Streaming tokenization took {elapsed:.5f}s"):
+        for sentence in sentences:
+            yield json.dumps(sentence).encode("utf-8") + b"\n"
 
 
 @app.get("/tokenize", responses=TOKENIZE_OUT, response_class=Response)
@@ -99,39 +127,250 @@ def tokenize(
     if accept == "*/*":
         accept = "application/msgpack"
 
-    if accept not in {"application/msgpack", "application/json"}:
+    if accept not in TOKENIZE_ACCEPT:
         logger.error(f"Received bad header: {accept}")
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
-            detail=f"Expected accept header application/msgpack, application/json, got {accept}",
+            detail=f"Expected accept header {', '.join(sorted(TOKENIZE_ACCEPT))}, got {accept}",
         )
 
     with timer("Opening model took {elapsed:.5f}s"):
-        tokenizer = Tokenizer.from_cache(f"./cache/{model}.spacy", model)
-
-    with timer("Tokenization took {elapsed:.5f}s"):
-        sentences = tokenizer.stream_tokenize(sentences)
-
-    with timer("Serialization took {elapsed:.5f}s"):
-        if accept == "application/msgpack":
-            response = BytesIO()
-            response.write(b"\x81")
-            response.write((0x5 << 5 | len("sentences")).to_bytes(1, byteorder="big"))
-            response.write(b"sentences")
-            write_array_len(response, len_sentences)
-
-            for sentence in sentences:
-                response.write(sentence.msgpack)
-            response.seek(0)
-            output = StreamingResponse(response, media_type="application/msgpack")
-        else:
-            output = JSONResponse(
-                {"sentences": [sentence.json for sentence in sentences]},
-                media_type="application/json",
-            )
+        tokenizer = Tokenizer.from_cache(cache_path(model), model, request.profile)
+
+    if accept == "application/msgpack":
+        return StreamingResponse(
+            streaming_sentences(len_sentences, tokenizer.stream_msgpack(sentences)),
+            media_type="application/msgpack",
+        )
+
+    if accept == "application/x-ndjson":
+        return StreamingResponse(
+            streaming_ndjson(tokenizer.stream_json(sentences)),
+            media_type="application/x-ndjson",
+        )
+
+    with timer("Tokenization and serialization took {elapsed:.5f}s"):
+        output = JSONResponse(
+            {"sentences": list(tokenizer.stream_json(sentences))},
+            media_type="application/json",
+        )
     return output
 
 
+class EntitiesIn(BaseModel):
+    sentences: List[str]
+
+
+class EntitySpan(BaseModel):
+    start: int
+    end: int
+    label: str
+
+
+class EntityDisplay(BaseModel):
+    text: str
+    ents: List[EntitySpan]
+
+
+class SentenceEntities(BaseModel):
+    ner: EntityDisplay
+    srl: List[EntityDisplay]
+
+
+class EntitiesOut(BaseModel):
+    entities: List[SentenceEntities]
+
+
+ENTITIES_OUT = {
+    int(HTTPStatus.OK): {
+        "description": "NER and SRL entities of each input sentence, formatted for spaCy's displacy",
+        "content": {
+            "application/msgpack": {},
+            "application/json": {
+                "schema": EntitiesOut.schema(ref_template=REF_TEMPLATE),
+            },
+        },
+    }
+}
+
+
+@app.post("/entities", responses=ENTITIES_OUT, response_class=Response)
+def entities(
+    request: EntitiesIn, accept: Optional[str] = Header(default="application/msgpack")
+):
+    """Performs NER and SRL analysis of each sentence, requesting uncached sentences concurrently."""
+    if accept == "*/*":
+        accept = "application/msgpack"
+
+    if accept not in {"application/msgpack", "application/json"}:
+        logger.error(f"Received bad header: {accept}")
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Expected accept header application/msgpack, application/json, got {accept}",
+        )
+
+    analyzer = EntityAnalyzer.from_cache()
+
+    with timer("Entity analysis took {elapsed:.5f}s"):
+        try:
+            output = {"entities": analyzer.entities_many(request.sentences)}
+        except NLPError as e:
+            raise HTTPException(status_code=HTTPStatus.BAD_GATEWAY, detail=str(e))
+
+    if accept == "application/msgpack":
+        return Response(msgpack.packb(output), media_type="application/msgpack")
+    return JSONResponse(output, media_type="application/json")
+
+
+class SimilarIn(BaseModel):
+    model: SpacyModel = SpacyModel.EN_LG
+    sentence: str
+    k: int = 10
+
+
+class SimilarSentence(BaseModel):
+    sentence: str
+    score: float
+
+
+class SimilarOut(BaseModel):
+    sentences: List[SimilarSentence]
+
+
+@app.post("/similar", response_model=SimilarOut)
+def similar(request: SimilarIn):
+    """Finds the `k` tokenized sentences with the highest word-vector cosine similarity to the given sentence.
+    Only sentences which have been tokenized with the model (eg. by `/tokenize`) are searched."""
+    tokenizer = Tokenizer.from_cache(cache_path(request.model), request.model)
+    if tokenizer.vector_index is None:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Model {request.model} does not have word vectors",
+        )
+
+    with timer("Similarity search took {elapsed:.5f}s"):
+        matches = tokenizer.similar(request.sentence, request.k)
+    return SimilarOut(
+        sentences=[
+            SimilarSentence(sentence=sentence, score=score)
+            for sentence, score in matches
+        ]
+    )
+
+
+class CorpusItem(BaseModel):
+    path: str
+    # Sentences of the item's documentation
+    sentences: List[str]
+
+
+class CorpusIn(BaseModel):
+    model: SpacyModel = SpacyModel.EN_SM
+    items: List[CorpusItem]
+
+
+class CorpusOut(BaseModel):
+    model: SpacyModel
+    items: int
+    sentences: int
+
+
+def corpus_out(corpus: CorpusIndex) -> CorpusOut:
+    return CorpusOut(
+        model=corpus.tokenizer.model,
+        items=len(corpus),
+        sentences=len(corpus.sentences),
+    )
+
+
+@app.post("/corpus/{name}", response_model=CorpusOut)
+def upload_corpus(name: str, request: CorpusIn):
+    """Tokenizes the sentences of each item, and adds the items to the named corpus, creating it if it does not
+    exist. Tokens are cached as in `/tokenize`, and the corpus is held in memory to be searched by `/search`."""
+    tokenizer = Tokenizer.from_cache(cache_path(request.model), request.model)
+    with CORPORA_LOCK:
+        corpus = CORPORA.setdefault(name, CorpusIndex(tokenizer))
+    if corpus.tokenizer.model != request.model:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Corpus {name} was tokenized with {corpus.tokenizer.model}, got {request.model}",
+        )
+
+    with timer("Indexing corpus took {elapsed:.5f}s"):
+        corpus.add_items((item.path, item.sentences) for item in request.items)
+    return corpus_out(corpus)
+
+
+@app.get("/corpus", response_model=Dict[str, CorpusOut])
+async def corpora():
+    with CORPORA_LOCK:
+        corpora = dict(CORPORA)
+    return {name: corpus_out(corpus) for name, corpus in corpora.items()}
+
+
+@app.delete("/corpus/{name}", response_model=CorpusOut)
+def delete_corpus(name: str):
+    with CORPORA_LOCK:
+        corpus = CORPORA.pop(name, None)
+    if corpus is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"No corpus named {name}",
+        )
+    return corpus_out(corpus)
+
+
+class SearchIn(BaseModel):
+    corpus: str
+    query: str
+
+
+class SearchMatchOut(BaseModel):
+    path: str
+    # Number of sentences in the item's docs matching each phrase of the query, summed
+    score: int
+
+
+SEARCH_OUT = {
+    int(HTTPStatus.OK): {
+        "description": "Items matching the query, in the order they were added, as one JSON-encoded match per line",
+        "content": {
+            "application/x-ndjson": {
+                "schema": SearchMatchOut.schema(ref_template=REF_TEMPLATE),
+            },
+        },
+    }
+}
+
+
+def streaming_matches(corpus: CorpusIndex, query: SearchQuery):
+    """Streams one JSON-encoded match per line, as each match is found."""
+    with timer("Search took {elapsed:.5f}s"):
+        for match in corpus.iter_matches(query):
+            yield json.dumps(match._asdict()).encode("utf-8") + b"\n"
+
+
+@app.post("/search", responses=SEARCH_OUT, response_class=Response)
+def search(request: SearchIn):
+    """Forms a query from the sentence (see `nlp_query.query_from_sentence`), and streams the paths of the items
+    in the corpus which match it, with their number of matching sentences, as they are found. Matches are not
+    ranked, so that the first match is sent without waiting for the whole corpus to be searched.
+    The query is tagged without adding it to the token cache, store or vector index."""
+    with CORPORA_LOCK:
+        corpus = CORPORA.get(request.corpus)
+    if corpus is None:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail=f"No corpus named {request.corpus}",
+        )
+
+    tokenizer = corpus.tokenizer
+    query = query_from_tokens(tokenizer.tag_uncached(request.query), tokenizer)
+    return StreamingResponse(
+        streaming_matches(corpus, query), media_type="application/x-ndjson"
+    )
+
+
 class Explain(BaseModel):
     explanation: Optional[str]
 
@@ -152,56 +391,87 @@ async def models(
     ),
     lang: str = "en",
 ):
-    import requests
-    from spacy import about
-    from spacy.cli.validate import reformat_version
-    from spacy.util import (get_installed_models, get_model_meta,
-                            get_package_path, get_package_version,
-                            is_compatible_version)
-
-    r = requests.get(about.__compatibility__)
-
-    if r.status_code != 200:
-        return Response("", status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
-
-    compat = r.json()["spacy"]
-    all_models = set()
-    installed_models = get_installed_models()
-    for spacy_v, models in dict(compat).items():
-        all_models.update(models.keys())
-        for model, model_vs in models.items():
-            compat[spacy_v][model] = [reformat_version(v) for v in model_vs]
-    pkgs = {}
-
-    for pkg_name in installed_models:
-        package = pkg_name.replace("-", "_")
-        version = get_package_version(pkg_name)
-        if package in compat:
-            is_compat = version in compat[package]
-            spacy_version = about.__version__
-            model_meta = {}
-        else:
-            model_path = get_package_path(package)
-            model_meta = get_model_meta(model_path)
-            spacy_version = model_meta.get("spacy_version", "n/a")
-            is_compat = is_compatible_version(about.__version__, spacy_version)  # type: ignore[assignment]
-        pkgs[pkg_name] = {
-            "name": package,
-            "version": version,
-            "spacy": spacy_version,
-            "compat": is_compat,
-            "meta": model_meta,
-        }
-
-    matches = []
-    for name, data in pkgs.items():
-        if data["meta"].get("lang") == lang and data["compat"]:
-            components = data["meta"].get("components")
-            model_has_vec = components and "tok2vec" in components
-            if has_vec is None or model_has_vec == has_vec:
-                matches.append(name)
-
-    return Models(models=matches)
+    """Lists the installed models for the given language which are compatible with this version of spaCy.
+    Models are read from the model registry, which is built at startup (see `/models/refresh`)."""
+    return Models(models=REGISTRY.find(lang, has_vec))
+
+
+@app.post("/models/refresh", response_model=Models)
+def refresh_models(lang: str = "en"):
+    """Rebuilds the model registry from the installed packages, eg. after installing a model.
+    Lists the compatible models for the given language, as in `/models`."""
+    REGISTRY.refresh()
+    return Models(models=REGISTRY.find(lang))
+
+
+class CacheStats(BaseModel):
+    entries: int
+    bytes: int
+    max_bytes: Optional[int]
+    hits: int
+    misses: int
+    store_hits: int
+    evictions: int
+
+
+class BatchStats(BaseModel):
+    batches: int
+    sentences: int
+    pending: int
+
+
+class CachesOut(BaseModel):
+    # Keyed by "{model}/{profile}"
+    tokens: Dict[str, CacheStats]
+    # Entities are shared by all models
+    entities: CacheStats
+    # Batch scheduler counters, keyed by "{model}/{profile}"
+    batches: Dict[str, BatchStats]
+
+
+@app.get("/cache", response_model=CachesOut)
+async def cache_stats():
+    """Reports the size, budget, and hit/miss/eviction counters of each model's caches, and how many
+    batches and sentences each model's batch scheduler has tagged."""
+    return CachesOut(
+        tokens=Tokenizer.TOKEN_CACHE.stats(),
+        entities=EntityAnalyzer.CACHE.stats(),
+        batches={
+            str(pipeline): scheduler.stats()
+            for pipeline, scheduler in Tokenizer.SCHEDULERS.items()
+        },
+    )
+
+
+class ModelLoadStatus(BaseModel):
+    state: LoadState
+    # Seconds spent loading the tagger, opening the caches, and tagging the warm-up batch
+    timings: Dict[str, float]
+    error: Optional[str]
+
+
+class ReadyOut(BaseModel):
+    ready: bool
+    models: Dict[str, ModelLoadStatus]
+
+
+@app.get(
+    "/ready",
+    response_model=ReadyOut,
+    responses={int(HTTPStatus.SERVICE_UNAVAILABLE): {"model": ReadyOut}},
+)
+async def ready():
+    """Reports whether each model in PRELOAD_MODELS has loaded. Responds with 503 until all have."""
+    status = WARMUP.json()
+    if not status["ready"]:
+        return JSONResponse(status, status_code=HTTPStatus.SERVICE_UNAVAILABLE)
+    return status
+
+
+@app.on_event("startup")
+def startup():
+    WARMUP.start()
+    REGISTRY.refresh()
 
 
 @app.get("/docs", response_class=HTMLResponse, include_in_schema=False)
@@ -226,16 +496,25 @@ async def docs():
 
 @app.on_event("shutdown")
 def shutdown():
-    with timer("Persisting cache took {elapsed:.5f}s"):
-        for model in Tokenizer.TOKEN_CACHE.keys():
-            Tokenizer(model).write_data(f"./cache/{model}.spacy")
+    with timer("Closing cache took {elapsed:.5f}s"):
+        # Schedulers finish their pending batches, which need the pools and stores
+        for scheduler in Tokenizer.SCHEDULERS.values():
+            scheduler.shutdown()
+        for pool in Tokenizer.POOLS.values():
+            pool.shutdown()
+        for store in Tokenizer.STORES.values():
+            store.close()
+        EntityAnalyzer.close()
+        for index in Tokenizer.VECTOR_INDEXES.values():
+            index.close()
+    close_service_client()
 
 
 def custom_openapi():
     if app.openapi_schema:
         return app.openapi_schema
 
-    for component in (Token, SentenceOut):
+    for component in (Token, SentenceOut, EntitySpan, EntityDisplay, SentenceEntities):
         openapi["components"]["schemas"][component.__name__] = component.schema(
             ref_template=REF_TEMPLATE
         )
@@ -1,8 +1,17 @@
-import torch
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from os import getenv
+from typing import Callable, List, Optional, Tuple
 
+import numpy as np
+from spacy.attrs import IS_STOP, ORTH, POS
+from spacy.symbols import NOUN, PROPN, VERB
+from spacy.tokens import Doc
+
+from cache import env_bytes, make_cache
 from tokenizer import SpacyModel, Tokenizer
 
+# Rough memory held by a memoized BERT score, including the pair of sentences in its key
+BERT_ENTRY_BYTES = 512
+
 
 class Space:
     def __init__(self, width: int):
@@ -12,7 +21,93 @@ class Space:
         return " " * self.width
 
 
-class NaiveSimilarity:
+def as_numpy(array) -> np.ndarray:
+    """Copies arrays on the GPU (when spaCy prefers the GPU) to host memory."""
+    return array if isinstance(array, np.ndarray) else array.get()
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scales each row to unit length. Rows without a vector are left as zeros, so that their
+    similarity to everything is 0, as in spaCy."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def no_stop_mask(doc: Doc) -> np.ndarray:
+    return ~doc.to_array(IS_STOP).astype(bool)
+
+
+NOUN_VERB_POS = [NOUN, PROPN, VERB]
+
+
+def noun_verb_mask(doc: Doc) -> np.ndarray:
+    return np.isin(doc.to_array(POS), NOUN_VERB_POS)
+
+
+class VectorSimilarity:
+    """
+    Computes the word-vector cosine similarity of many sentences at once, by stacking the vectors
+    of the tokenized sentences into a matrix, and taking a single matrix product.
+
+    If `mask_fn` is provided, each sentence's vector is the average of the vectors of the tokens
+    selected by `mask_fn(doc)` (a boolean array with one entry per token), rather than the Doc's vector.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, mask_fn: Optional[Callable] = None):
+        self.tokenizer = tokenizer
+        self.mask_fn = mask_fn
+
+    def masked_vector(self, doc: Doc) -> np.ndarray:
+        vectors = doc.vocab.vectors
+        mask = self.mask_fn(doc)
+        if not mask.any():
+            return np.zeros(vectors.shape[1], dtype="f4")
+        # Tokens without a vector count as zeros, as in Doc.vector
+        rows = as_numpy(vectors.find(keys=doc.to_array(ORTH)[mask]))
+        found = rows >= 0
+        token_vectors = as_numpy(vectors.data[rows[found]])
+        return token_vectors.sum(axis=0) / mask.sum()
+
+    def vectors(self, sentences: List[str]) -> np.ndarray:
+        """Returns a (len(sentences), width) matrix of sentence vectors, tagging all uncached
+        sentences in one batch. Unmasked vectors are read from the sentences' msgpack payloads, so the
+        Docs of stored sentences are only loaded for masked vectors."""
+        width = self.tokenizer.tagger.vocab.vectors.shape[1]
+        rows = []
+        for tokenized in self.tokenizer.stream_tokenize(sentences):
+            if self.mask_fn is None:
+                vector = tokenized.vector()
+                rows.append(
+                    vector if vector is not None else np.zeros(width, dtype="f4")
+                )
+            else:
+                rows.append(self.masked_vector(tokenized.doc))
+        if not rows:
+            return np.zeros((0, width), dtype="f4")
+        return np.stack(rows).astype("f4", copy=False)
+
+    def all_pairs(self, sentences: List[str]) -> np.ndarray:
+        """Returns the (n, n) matrix of similarities between all pairs of sentences."""
+        unit = normalize_rows(self.vectors(sentences))
+        return unit @ unit.T
+
+    def one_to_many(self, query: str, candidates: List[str]) -> np.ndarray:
+        """Returns the similarity of `query` to each candidate."""
+        unit = normalize_rows(self.vectors([query, *candidates]))
+        return unit[1:] @ unit[0]
+
+    def pairs(self, sentence_pairs: List[Tuple[str, str]]) -> np.ndarray:
+        """Returns the similarity of each (sent_a, sent_b) pair."""
+        unit = normalize_rows(
+            self.vectors([s for pair in sentence_pairs for s in pair])
+        )
+        return np.einsum("ij,ij->i", unit[0::2], unit[1::2])
+
+    def __call__(self, sent1: str, sent2: str):
+        return float(self.pairs([(sent1, sent2)])[0])
+
+
+class NaiveSimilarity(VectorSimilarity):
     """
     Uses the word-vector cosine similarity metric. In practice, is quite fast,
     but does not detect reordering of words.
@@ -22,33 +117,17 @@ class NaiveSimilarity:
     """
 
     def __init__(self, tokenizer: Tokenizer):
-        self.tokenizer = tokenizer
-
-    def __call__(self, sent1: str, sent2: str):
-        s1 = self.tokenizer.tokenize(sent1)
-        s2 = self.tokenizer.tokenize(sent2)
-        return s1.doc.similarity(s2.doc)
+        super().__init__(tokenizer)
 
 
-class SimilarityFilter:
+class SimilarityFilter(VectorSimilarity):
     """
     Uses the word-vector cosine similarity metric, applying some filter over the individual
     tokens (words). Refer to NaiveSimilarity docs for information on strengths and weaknesses
     """
 
-    def __init__(self, tokenizer: Tokenizer, filter_fn):
-        self.tokenizer = tokenizer
-        self.filter_fn = filter_fn
-
-    def filtered_sentence(self, sent):
-        s = self.tokenizer.tokenize(sent)
-        sent = " ".join(str(t) for t in s.doc if self.filter_fn(t))
-        return self.tokenizer.tokenize(sent)
-
-    def __call__(self, sent1: str, sent2: str):
-        s1 = self.filtered_sentence(sent1)
-        s2 = self.filtered_sentence(sent2)
-        return s1.doc.similarity(s2.doc)
+    def __init__(self, tokenizer: Tokenizer, mask_fn: Callable):
+        super().__init__(tokenizer, mask_fn)
 
 
 class SimilarityNoStop(SimilarityFilter):
@@ -58,7 +137,7 @@ class SimilarityNoStop(SimilarityFilter):
     """
 
     def __init__(self, tokenizer: Tokenizer):
-        super().__init__(tokenizer, lambda t: not t.is_stop)
+        super().__init__(tokenizer, no_stop_mask)
 
 
 class SimilarityNouns(SimilarityFilter):
@@ -68,7 +147,7 @@ class SimilarityNouns(SimilarityFilter):
     """
 
     def __init__(self, tokenizer: Tokenizer):
-        super().__init__(tokenizer, lambda t: t.pos_ in {"NOUN", "PROPN", "VERB"})
+        super().__init__(tokenizer, noun_verb_mask)
 
 
 class SimilarityBert:
@@ -77,20 +156,145 @@ class SimilarityBert:
 
     Is very effective at detecting dissimilar sentences, but underperforms when measuring if sentences
     are similar.
+
+    Pairs are scored in batches, grouping pairs of similar length to minimize padding, and scores
+    are memoized by pair (up to BERT_CACHE_SIZE bytes), so repeated comparisons are not recomputed.
+    BERT_BATCH_SIZE sets the number of pairs per batch, and BERT_THREADS the number of CPU threads used by torch.
     """
 
-    def __init__(self):
+    def __init__(self, batch_size: Optional[int] = None, threads: Optional[int] = None):
+        # torch and transformers are slow to import, so they are only imported when BERT is used
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self.batch_size = batch_size or int(getenv("BERT_BATCH_SIZE", 32))
+        threads = threads or int(getenv("BERT_THREADS", 0))
+        if threads:
+            torch.set_num_threads(threads)
+
         # Takes a long time to load these models
         model_name = "bert-base-cased-finetuned-mrpc"
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.eval()
+        self.scores = make_cache(
+            env_bytes("BERT_CACHE_SIZE", 16 * 2**20),
+            sizeof=lambda _: BERT_ENTRY_BYTES,
+        )
+
+    def _encode(self, pairs: List[Tuple[str, str]]) -> List[dict]:
+        """Tokenizes each pair, without padding."""
+        encoded = self.tokenizer([a for a, _ in pairs], [b for _, b in pairs])
+        return [
+            {name: values[i] for name, values in encoded.items()}
+            for i in range(len(pairs))
+        ]
+
+    def _score_batch(self, features: List[dict]) -> List[float]:
+        import torch
+
+        tokens = self.tokenizer.pad(features, return_tensors="pt")
+        with torch.inference_mode():
+            classification_logits = self.model(**tokens)[0]
+            results = torch.softmax(classification_logits, dim=1)
+        return results[:, 1].tolist()
+
+    def score_pairs(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Returns the probability that each (sent_a, sent_b) pair is a paraphrase."""
+        known = {}
+        missing = []
+        for pair in dict.fromkeys(pairs):
+            score = self.scores.get(pair)
+            if score is None:
+                missing.append(pair)
+            else:
+                known[pair] = score
+
+        if missing:
+            features = self._encode(missing)
+            # Sorting by length keeps the padding within each batch small
+            order = sorted(
+                range(len(missing)), key=lambda i: len(features[i]["input_ids"])
+            )
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start : start + self.batch_size]
+                scores = self._score_batch([features[i] for i in batch])
+                for i, score in zip(batch, scores):
+                    known[missing[i]] = self.scores[missing[i]] = score
+
+        return [known[pair] for pair in pairs]
 
     def __call__(self, sent_a: str, sent_b: str):
-        tokens = self.tokenizer(sent_a, sent_b, return_tensors="pt")
-        classification_logits = self.model(**tokens)
-        classification_logits = classification_logits[0]
-        results = torch.softmax(classification_logits, dim=1).tolist()[0]
-        return results[1]
+        return self.score_pairs([(sent_a, sent_b)])[0]
+
+
+class CascadedSimilarity:
+    """
+    Ranks candidates with the cheap word-vector cosine similarity first, and only scores the most similar
+    candidates with BERT.
+
+    Candidates with a cosine similarity below `min_similarity` (CASCADE_MIN_SIMILARITY) are discarded,
+    and of the remainder, only the `top_k` (CASCADE_TOP_K) most similar are reranked by BERT.
+    Discarded candidates score 0. `stats` reports how many pairs each stage eliminated.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        bert: Optional[SimilarityBert] = None,
+        min_similarity: Optional[float] = None,
+        top_k: Optional[int] = None,
+    ):
+        self.vectors = NaiveSimilarity(tokenizer)
+        self.bert = bert or SimilarityBert()
+        if min_similarity is None:
+            min_similarity = float(getenv("CASCADE_MIN_SIMILARITY", 0.5))
+        self.min_similarity = min_similarity
+        if top_k is None:
+            top_k = int(getenv("CASCADE_TOP_K", 10))
+        self.top_k = top_k
+        self.compared = 0
+        self.below_threshold = 0
+        self.below_top_k = 0
+        self.reranked = 0
+
+    def _prefilter(self, cosine: np.ndarray) -> np.ndarray:
+        """Returns the indices of the candidates which pass the vector stage, most similar first."""
+        passed = np.flatnonzero(cosine >= self.min_similarity)
+        ranked = passed[np.argsort(-cosine[passed], kind="stable")][: self.top_k]
+        self.compared += len(cosine)
+        self.below_threshold += len(cosine) - len(passed)
+        self.below_top_k += len(passed) - len(ranked)
+        self.reranked += len(ranked)
+        return ranked
+
+    def rank(self, query: str, candidates: List[str]) -> List[Tuple[str, float]]:
+        """Returns the candidates which pass the vector stage, with their BERT scores,
+        in descending order of BERT score."""
+        ranked = self._prefilter(self.vectors.one_to_many(query, candidates))
+        scores = self.bert.score_pairs([(query, candidates[i]) for i in ranked])
+        results = [(candidates[i], score) for i, score in zip(ranked, scores)]
+        return sorted(results, key=lambda x: x[1], reverse=True)
+
+    def score_pairs(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Scores each pair with BERT if it passes the vector stage, and 0 otherwise.
+        `top_k` applies to all of the pairs together."""
+        ranked = self._prefilter(self.vectors.pairs(pairs))
+        results = [0.0] * len(pairs)
+        for i, score in zip(ranked, self.bert.score_pairs([pairs[i] for i in ranked])):
+            results[i] = score
+        return results
+
+    def __call__(self, sent1: str, sent2: str):
+        return self.score_pairs([(sent1, sent2)])[0]
+
+    def stats(self) -> dict:
+        return {
+            "pairs": self.compared,
+            "below_threshold": self.below_threshold,
+            "below_top_k": self.below_top_k,
+            "reranked": self.reranked,
+        }
 
 
 def similarity_metrics(sentence_pairs):
@@ -99,12 +303,14 @@ def similarity_metrics(sentence_pairs):
     s_nostop = SimilarityNoStop(p)
     s_nouns = SimilarityNouns(p)
     s_bert = SimilarityBert()
+    s_cascade = CascadedSimilarity(p, s_bert)
 
     sims = [
         ("naive", s_naive),
         ("nostop", s_nostop),
         ("nouns", s_nouns),
         ("bert", s_bert),
+        ("cascade", s_cascade),
     ]
 
     for sent1, sent2 in sentence_pairs:
@@ -115,6 +321,9 @@ def similarity_metrics(sentence_pairs):
         for name, sim_metric in sims:
             print(f"{Space(8)}{name}: {sim_metric(sent1, sent2)}")
 
+    print("=" * 80)
+    print(f"cascade: {s_cascade.stats()}")
+
 
 # TODO: Expose this in a server API
 if __name__ == "__main__":
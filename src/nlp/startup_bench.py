@@ -0,0 +1,85 @@
+# Measures the cold-start time of the CLI, and fails if it exceeds the startup budget, or if any heavy
+# dependency is imported just to print the help text.
+#
+# Usage (from src/): python nlp/startup_bench.py [--runs N]
+# The budget is set by STARTUP_BUDGET_MS (200 by default).
+
+import re
+import statistics
+import subprocess
+import sys
+import time
+from os import getenv
+from pathlib import Path
+
+import click
+
+SRC_DIR = Path(__file__).parent.parent
+COMMAND = [sys.executable, "-m", "nlp", "--help"]
+# Dependencies which should only be imported by the commands which use them
+HEAVY_MODULES = {
+    "spacy",
+    "numpy",
+    "msgpack",
+    "torch",
+    "transformers",
+    "uvicorn",
+    "fastapi",
+    "httpx",
+}
+# eg. "import time:       412 |      10245 | spacy"
+IMPORT_TIME = re.compile(r"^import time:\s+\d+\s+\|\s+(\d+)\s+\|\s+(\S+)$")
+
+
+def time_command() -> float:
+    start = time.perf_counter()
+    subprocess.run(COMMAND, cwd=SRC_DIR, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def import_times():
+    """Returns (module, cumulative microseconds) for each top-level import, as reported by -X importtime."""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", *COMMAND[1:]],
+        cwd=SRC_DIR,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    for line in res.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is not None:
+            yield match.group(2), int(match.group(1))
+
+
+@click.command()
+@click.option("--runs", default=10, help="Number of timed runs")
+@click.option("--top", default=10, help="Number of slowest imports to show")
+def main(runs: int, top: int):
+    budget = float(getenv("STARTUP_BUDGET_MS", 200))
+    # The first run warms the filesystem and bytecode caches
+    time_command()
+    elapsed = sorted(time_command() * 1000 for _ in range(runs))
+    median = statistics.median(elapsed)
+    print(f"{' '.join(COMMAND[1:])}: median {median:.1f}ms, min {elapsed[0]:.1f}ms")
+
+    imports = list(import_times())
+    print("Slowest imports:")
+    for module, micros in sorted(imports, key=lambda x: x[1], reverse=True)[:top]:
+        print(f"    {module}: {micros / 1000:.1f}ms")
+
+    failures = []
+    heavy = sorted({module.split(".")[0] for module, _ in imports} & HEAVY_MODULES)
+    if heavy:
+        failures.append(f"--help imports {', '.join(heavy)}")
+    if median > budget:
+        failures.append(f"median startup {median:.1f}ms exceeds budget of {budget:.0f}ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from hashlib import blake2b
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+LOGGER = logging.getLogger(__name__)
+
+# key (hash of sentence), payload length
+RECORD_HEADER = struct.Struct("<16sI")
+# crc32 of payload, written after the payload so that torn writes can be detected
+RECORD_FOOTER = struct.Struct("<I")
+# key, payload offset, payload length - one entry per record, in the segment's .idx file
+INDEX_ENTRY = struct.Struct("<16sQI")
+SEGMENT_GLOB = "*.seg"
+VERSION_FILE = "VERSION"
+
+
+def sentence_key(sentence: str) -> bytes:
+    return blake2b(sentence.encode("utf-8"), digest_size=16).digest()
+
+
+def map_file(path: Path) -> Optional[mmap.mmap]:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def scan_segment(data, offset: int = 0) -> Tuple[List[Tuple[bytes, int, int]], int]:
+    """Reads all complete records in the segment data, starting at `offset`, returning
+    (key, payload offset, payload length) for each record, and the end of the last valid record."""
+    records = []
+    while offset + RECORD_HEADER.size <= len(data):
+        key, length = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if end + RECORD_FOOTER.size > len(data):
+            break
+        (checksum,) = RECORD_FOOTER.unpack_from(data, end)
+        if checksum != zlib.crc32(data[start:end]):
+            break
+        records.append((key, start, length))
+        offset = end + RECORD_FOOTER.size
+    return records, offset
+
+
+def read_index(path: Path, segment) -> List[Tuple[bytes, int, int]]:
+    """Reads the entries of a segment's index, up to the first entry which is incomplete, refers to a
+    record that was not fully written to the segment, or does not match the header of the record it
+    refers to (eg. if compaction was interrupted after replacing the segment, but not its index)."""
+    if segment is None or not path.exists():
+        return []
+    data = path.read_bytes()
+    entries = []
+    for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+        key, start, length = INDEX_ENTRY.unpack_from(data, offset)
+        header = start - RECORD_HEADER.size
+        if header < 0 or start + length + RECORD_FOOTER.size > len(segment):
+            break
+        if RECORD_HEADER.unpack_from(segment, header) != (key, length):
+            break
+        entries.append((key, start, length))
+    return entries
+
+
+class SegmentStore:
+    """An append-only key-value store on disk, keyed by `sentence_key`.
+
+    Records are appended to the active segment as they are produced, so that a crash loses at most the
+    records which have not yet been flushed. Each process writes to a fresh segment, which is sealed once
+    it exceeds `segment_bytes`. When more than `max_segments` sealed segments exist - after sealing a segment,
+    or when the store is opened, as each process leaves behind its own segment - they are merged into a
+    single segment, dropping duplicate records. The merged segment is written without holding the store's lock,
+    which is only taken to swap it in, so reads and writes are not blocked while compacting.
+
+    Each segment has an index file holding the key and location of each record, so opening the store
+    only reads the indices. Payloads are read on demand from memory-mapped segments.
+
+    `version` identifies the format of the payloads - if the store on disk was written with a different
+    version, its segments are discarded.
+    """
+
+    def __init__(
+        self,
+        path: Union[Path, str],
+        segment_bytes: int = 64 * 2**20,
+        max_segments: int = 8,
+        version: int = 1,
+    ):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self.version = version
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.lock = threading.RLock()
+        # Held while compacting, so that only one thread compacts the store at a time
+        self.compact_lock = threading.RLock()
+        # key -> (segment id, payload offset, payload length)
+        self.index: Dict[bytes, Tuple[int, int, int]] = {}
+        self.segments: Dict[int, Path] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._active: Optional[BinaryIO] = None
+        self._active_index: Optional[BinaryIO] = None
+        self._active_id: Optional[int] = None
+
+        self._check_version()
+        for path in sorted(self.path.glob(SEGMENT_GLOB)):
+            self._load_segment(int(path.stem), path)
+        self._compact_if_needed()
+
+    def _check_version(self):
+        version_path = self.path / VERSION_FILE
+        if version_path.exists():
+            version = int(version_path.read_text())
+        elif any(self.path.glob(SEGMENT_GLOB)):
+            # Stores written before versioning was introduced have no version file
+            version = 1
+        else:
+            version = self.version
+        if version != self.version:
+            LOGGER.warning(
+                f"Discarding {self.path}, which has version {version} (expected {self.version})"
+            )
+            for path in self.path.glob(SEGMENT_GLOB):
+                path.unlink()
+                path.with_suffix(".idx").unlink(missing_ok=True)
+        version_path.write_text(str(self.version))
+
+    def _segment_path(self, ident: int) -> Path:
+        return self.path / f"{ident:08d}.seg"
+
+    def _load_segment(self, ident: int, path: Path):
+        data = map_file(path)
+        size = len(data) if data is not None else 0
+        index_path = path.with_suffix(".idx")
+        entries = read_index(index_path, data)
+        indexed_end = 0
+        if entries:
+            _, start, length = entries[-1]
+            indexed_end = start + length + RECORD_FOOTER.size
+
+        # Records written after the last index entry (eg. if the process crashed before flushing
+        # the index) are recovered by scanning the remainder of the segment.
+        unindexed, valid_end = [], indexed_end
+        if indexed_end < size:
+            unindexed, valid_end = scan_segment(data, indexed_end)
+        if data is not None:
+            data.close()
+
+        if valid_end != size:
+            LOGGER.warning(f"Truncating torn records at end of {path}")
+            os.truncate(path, valid_end)
+
+        index_size = INDEX_ENTRY.size * len(entries)
+        index_stale = not index_path.exists() or index_path.stat().st_size != index_size
+        if unindexed or index_stale:
+            with open(index_path, "a+b") as f:
+                f.truncate(index_size)
+                for entry in unindexed:
+                    f.write(INDEX_ENTRY.pack(*entry))
+
+        for key, offset, length in entries + unindexed:
+            self.index.setdefault(key, (ident, offset, length))
+        self.segments[ident] = path
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _writer(self) -> BinaryIO:
+        if self._active is None:
+            self._active_id = max(self.segments, default=-1) + 1
+            path = self._segment_path(self._active_id)
+            self.segments[self._active_id] = path
+            self._active = open(path, "ab")
+            self._active_index = open(path.with_suffix(".idx"), "ab")
+        return self._active
+
+    def put(self, key: bytes, payload: bytes) -> bool:
+        """Appends the payload under the given key, unless the key is already present.
+        Returns whether the payload was written."""
+        with self.lock:
+            if key in self.index:
+                return False
+            writer = self._writer()
+            offset = writer.tell() + RECORD_HEADER.size
+            writer.write(RECORD_HEADER.pack(key, len(payload)))
+            writer.write(payload)
+            writer.write(RECORD_FOOTER.pack(zlib.crc32(payload)))
+            self._active_index.write(INDEX_ENTRY.pack(key, offset, len(payload)))
+            self.index[key] = (self._active_id, offset, len(payload))
+            sealed = writer.tell() >= self.segment_bytes
+            if sealed:
+                self._seal()
+        # Compaction takes the lock itself, only to swap in the merged segment
+        if sealed:
+            self._compact_if_needed()
+        return True
+
+    def _map(self, ident: int, end: int) -> mmap.mmap:
+        """Returns the memory-mapped segment, remapping it if it has grown past the current mapping."""
+        data = self._maps.get(ident)
+        if data is None or len(data) < end:
+            if ident == self._active_id:
+                self.flush()
+            if data is not None:
+                data.close()
+            data = self._maps[ident] = map_file(self.segments[ident])
+        return data
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        """Reads the payload stored under the given key. Returns None if the key is not present,
+        or if the record is corrupted."""
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return None
+            ident, offset, length = location
+            data = self._map(ident, offset + length + RECORD_FOOTER.size)
+            payload = data[offset : offset + length]
+            (checksum,) = RECORD_FOOTER.unpack_from(data, offset + length)
+
+        if checksum != zlib.crc32(payload):
+            LOGGER.warning(f"Discarding corrupted record in {self.segments[ident]}")
+            return None
+        return payload
+
+    def _by_segment(self) -> Dict[int, List[Tuple[bytes, int, int]]]:
+        by_segment = {}
+        for key, (ident, offset, length) in self.index.items():
+            by_segment.setdefault(ident, []).append((key, offset, length))
+        return by_segment
+
+    def keys(self) -> List[bytes]:
+        """Returns the keys of all records in the store, without reading any payloads."""
+        with self.lock:
+            return list(self.index)
+
+    def items(self) -> Iterator[Tuple[bytes, bytes]]:
+        """Produces all (key, payload) pairs in the store."""
+        for key in self.keys():
+            payload = self.get(key)
+            if payload is not None:
+                yield key, payload
+
+    def flush(self):
+        with self.lock:
+            if self._active is not None:
+                self._active.flush()
+                self._active_index.flush()
+
+    def _close_maps(self, idents):
+        for ident in idents:
+            data = self._maps.pop(ident, None)
+            if data is not None:
+                data.close()
+
+    def _seal(self):
+        self._active.close()
+        self._active_index.close()
+        self._close_maps([self._active_id])
+        self._active = None
+        self._active_index = None
+        self._active_id = None
+
+    def _sealed(self) -> List[int]:
+        return sorted(ident for ident in self.segments if ident != self._active_id)
+
+    def _compact_if_needed(self):
+        with self.compact_lock:
+            with self.lock:
+                needed = len(self._sealed()) > self.max_segments
+            if needed:
+                self.compact()
+
+    def compact(self):
+        """Merges all sealed segments into one, keeping a single record per key. Sealed segments are
+        never written to, so the merged segment is built from a snapshot of their records without holding
+        the lock, which is only taken to replace the sealed segments with the merged segment."""
+        with self.compact_lock:
+            with self.lock:
+                sealed = self._sealed()
+                if len(sealed) < 2:
+                    return
+                by_segment = self._by_segment()
+                records = {ident: by_segment.get(ident, []) for ident in sealed}
+
+            target = sealed[0]
+            target_path = self._segment_path(target)
+            tmp_path = target_path.with_suffix(".tmp")
+            tmp_index_path = target_path.with_suffix(".idx.tmp")
+            moved = {}
+            with open(tmp_path, "wb") as out, open(tmp_index_path, "wb") as out_index:
+                for ident in sealed:
+                    if not records[ident]:
+                        continue
+                    # Mapped separately from `_maps`, which readers may remap or close meanwhile
+                    data = map_file(self.segments[ident])
+                    try:
+                        for key, offset, length in records[ident]:
+                            payload = data[offset : offset + length]
+                            out.write(RECORD_HEADER.pack(key, length))
+                            moved[key] = (target, out.tell(), length)
+                            out_index.write(INDEX_ENTRY.pack(key, out.tell(), length))
+                            out.write(payload)
+                            out.write(RECORD_FOOTER.pack(zlib.crc32(payload)))
+                    finally:
+                        data.close()
+                for f in (out, out_index):
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            with self.lock:
+                self._close_maps(sealed)
+                os.replace(tmp_path, target_path)
+                os.replace(tmp_index_path, target_path.with_suffix(".idx"))
+                for ident in sealed[1:]:
+                    path = self.segments.pop(ident)
+                    path.unlink()
+                    path.with_suffix(".idx").unlink(missing_ok=True)
+                self.index.update(moved)
+            LOGGER.info(f"Compacted {len(sealed)} segments in {self.path}")
+
+    def close(self):
+        with self.lock:
+            if self._active is not None:
+                self._active.close()
+                self._active_index.close()
+                self._active = None
+                self._active_index = None
+                self._active_id = None
+            self._close_maps(list(self._maps))
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules are imported by name, as when running `python ./nlp/server.py`
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,128 @@
+import threading
+
+import pytest
+
+from cache import (CachePerModel, EvictionPolicy, LFUCache, LRUCache,
+                   env_bytes, make_cache)
+
+
+def sized(value: int) -> int:
+    # Values are their own size, so budgets are easy to reason about
+    return value
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=30, sizeof=sized)
+    cache["a"] = 10
+    cache["b"] = 10
+    cache["c"] = 10
+    assert cache["a"] == 10
+    cache["d"] = 10
+
+    assert set(cache) == {"a", "c", "d"}
+    assert cache.nbytes == 30
+    assert cache.evictions == 1
+
+
+def test_lfu_evicts_least_frequently_used():
+    cache = LFUCache(max_bytes=30, sizeof=sized)
+    cache["a"] = 10
+    cache["b"] = 10
+    cache["c"] = 10
+    for _ in range(2):
+        cache["a"]
+        cache["c"]
+    cache["b"]
+    cache["d"] = 10
+
+    # b and d were each used once - of those, b was used least recently
+    assert set(cache) == {"a", "c", "d"}
+
+
+def test_oversized_entry_is_kept_alone():
+    cache = LRUCache(max_bytes=10, sizeof=sized)
+    cache["a"] = 5
+    cache["b"] = 50
+
+    assert set(cache) == {"b"}
+
+
+def test_unbounded_cache_does_not_evict():
+    cache = make_cache(None, EvictionPolicy.LFU, sized)
+    for i in range(100):
+        cache[i] = 1000
+    assert len(cache) == 100
+    assert cache.evictions == 0
+
+
+def test_resize_evicts_others():
+    cache = LRUCache(max_bytes=30, sizeof=lambda value: value[0])
+    cache["a"] = [10]
+    cache["b"] = [10]
+    cache["b"][0] = 25
+    cache.resize("b")
+
+    assert set(cache) == {"b"}
+    assert cache.nbytes == 25
+
+
+def test_stats():
+    cache = LRUCache(sizeof=sized)
+    cache["a"] = 1
+    cache.get("a")
+    cache.get("b")
+    cache.store_hit()
+    assert "a" in cache
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["store_hits"] == 1
+    assert stats["entries"] == 1
+    assert stats["bytes"] == 1
+
+
+def test_cache_per_model_creates_each_cache_once():
+    created = []
+    barrier = threading.Barrier(8)
+
+    def factory(key):
+        created.append(key)
+        return LRUCache()
+
+    caches = CachePerModel(factory)
+    results = []
+
+    def first_request():
+        barrier.wait()
+        results.append(caches["model"])
+
+    threads = [threading.Thread(target=first_request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert created == ["model"]
+    assert all(cache is results[0] for cache in results)
+    assert set(caches.stats()) == {"model"}
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("512M", 512 * 2**20),
+        ("2g", 2 * 2**30),
+        ("1.5KB", 1536),
+        ("100", 100),
+        ("0", None),
+    ],
+)
+def test_env_bytes(monkeypatch, value, expected):
+    monkeypatch.setenv("TEST_CACHE_SIZE", value)
+    assert env_bytes("TEST_CACHE_SIZE", 1) == expected
+
+
+def test_env_bytes_default(monkeypatch):
+    monkeypatch.delenv("TEST_CACHE_SIZE", raising=False)
+    assert env_bytes("TEST_CACHE_SIZE", 7) == 7
@@ -0,0 +1,151 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("spacy")
+
+from nlp_query import CorpusIndex, Phrase, PhraseAutomaton, Query, Word
+
+
+def word(lemma: str, tag: str, optional: bool = False, synonyms=frozenset()) -> Word:
+    return Word(
+        lemma,
+        tag,
+        allow_synonyms=bool(synonyms),
+        is_optional=optional,
+        lemma=lemma,
+        synonyms=frozenset(synonyms),
+    )
+
+
+def phrase(*words: Word) -> Phrase:
+    return Phrase(list(words), tokenizer=None)
+
+
+def tokens(*pairs):
+    """Builds (tag, text, lemma) tokens from (lemma, tag) pairs."""
+    return tuple((tag, lemma, lemma) for lemma, tag in pairs)
+
+
+REMOVE_ELEMENT = phrase(
+    word("remove", "VB"), word("last", "JJ", optional=True), word("element", "NN")
+)
+
+
+@pytest.mark.parametrize(
+    "sentence, matches",
+    [
+        (tokens(("remove", "VBZ"), ("last", "JJ"), ("element", "NN")), True),
+        # Optional words may be skipped, and similar tags match
+        (tokens(("remove", "VBD"), ("element", "NNS")), True),
+        (tokens(("it", "PRP"), ("remove", "VBZ"), ("element", "NN"), (".", ".")), True),
+        # Words must be consecutive, in order
+        (tokens(("remove", "VBZ"), ("the", "DT"), ("element", "NN")), False),
+        (tokens(("element", "NN"), ("remove", "VBZ")), False),
+        # Tags must be similar
+        (tokens(("remove", "NN"), ("element", "NN")), False),
+        ((), False),
+    ],
+)
+def test_phrase_matches(sentence, matches):
+    assert REMOVE_ELEMENT.matches_tokens(sentence) == matches
+
+
+def test_synonyms_match():
+    largest = phrase(word("large", "JJ", synonyms={"big"}), word("value", "NN"))
+    assert largest.matches_tokens(tokens(("big", "JJ"), ("value", "NN")))
+    assert not largest.matches_tokens(tokens(("small", "JJ"), ("value", "NN")))
+
+
+def test_automaton_reports_each_matching_phrase():
+    phrases = [
+        REMOVE_ELEMENT,
+        phrase(word("return", "VB"), word("none", "NN")),
+        phrase(word("panic", "VB")),
+    ]
+    automaton = PhraseAutomaton(phrases)
+    sentence = tokens(
+        ("remove", "VBZ"),
+        ("element", "NN"),
+        ("and", "CC"),
+        ("return", "VBZ"),
+        ("none", "NN"),
+    )
+    assert automaton.run(sentence) == {0, 1}
+    assert automaton.run(tokens(("panic", "VBZ"))) == {2}
+
+
+def corpus(items) -> CorpusIndex:
+    tokenizer = SimpleNamespace(
+        stream_tokenize=lambda sentences: (
+            SimpleNamespace(metadata=sentence) for sentence in sentences
+        )
+    )
+    index = CorpusIndex(tokenizer)
+    index.add_items(items)
+    return index
+
+
+ITEMS = [
+    ("vec::pop", [tokens(("remove", "VBZ"), ("last", "JJ"), ("element", "NN"))]),
+    ("vec::push", [tokens(("append", "VBZ"), ("element", "NN"))]),
+    (
+        "vec::truncate",
+        [
+            tokens(("remove", "VBZ"), ("element", "NNS")),
+            tokens(("keep", "VBZ"), ("element", "NN")),
+            tokens(("remove", "VBZ"), ("element", "NNS")),
+        ],
+    ),
+]
+
+
+def test_candidates_require_words_in_order():
+    index = corpus(ITEMS)
+    assert list(index.candidates(REMOVE_ELEMENT)) == [0, 2, 4]
+
+
+def test_search_many_ranks_by_score():
+    index = corpus(ITEMS)
+    query = Query([REMOVE_ELEMENT])
+    (matches,) = index.search_many([query])
+    assert [(match.path, match.score) for match in matches] == [
+        ("vec::truncate", 2),
+        ("vec::pop", 1),
+    ]
+
+
+def test_iter_matches_in_order_added():
+    index = corpus(ITEMS)
+    query = Query([REMOVE_ELEMENT])
+    assert [(match.path, match.score) for match in index.iter_matches(query)] == [
+        ("vec::pop", 1),
+        ("vec::truncate", 2),
+    ]
+
+
+def test_search_sentences_does_not_keep_queries():
+    index = corpus(ITEMS)
+    query_tokens = tokens(("remove", "VB"), ("the", "DT"), ("element", "NN"))
+    docs = {
+        "remove the element": [
+            SimpleNamespace(text=text, tag_=tag, lemma_=lemma, is_stop=text == "the")
+            for tag, text, lemma in query_tokens
+        ]
+    }
+    # Corpus sentences are tokenized (and kept), queries are only tagged
+    index.tokenizer.tag_uncached_many = lambda sentences: [
+        SimpleNamespace(doc=docs[sentence]) for sentence in sentences
+    ]
+    del index.tokenizer.stream_tokenize
+
+    (matches,) = index.search_sentences(["remove the element"])
+    assert [match.path for match in matches] == ["vec::truncate", "vec::pop"]
+
+
+def test_every_phrase_must_match():
+    index = corpus(ITEMS)
+    query = Query([REMOVE_ELEMENT, phrase(word("keep", "VB"))])
+    assert [match.path for match in index.iter_matches(query)] == ["vec::truncate"]
+    assert index.search(query) == ["vec::truncate"]
+    assert list(index.iter_matches(Query([]))) == []
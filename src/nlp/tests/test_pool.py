@@ -0,0 +1,94 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import pool
+from pool import TaggerPool
+
+
+class FakeTokenizer:
+    def tag_records(self, sentences):
+        return [(sentence.encode("utf-8"), b"doc") for sentence in sentences]
+
+
+class BrokenExecutor:
+    """Behaves like a ProcessPoolExecutor after one of its workers died."""
+
+    def __init__(self, fail_submit: bool = False):
+        self.fail_submit = fail_submit
+        self.is_shutdown = False
+
+    def submit(self, fn, *args):
+        if self.fail_submit:
+            raise BrokenProcessPool("A child process terminated abruptly")
+        future = Future()
+        future.set_exception(BrokenProcessPool("A child process terminated abruptly"))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.is_shutdown = True
+
+
+@pytest.fixture
+def tagger_pool(monkeypatch):
+    """A pool whose workers are threads running a fake tokenizer, so that no model is loaded."""
+    monkeypatch.setattr(pool, "WORKER_TOKENIZER", FakeTokenizer())
+    started = []
+
+    def start_executor(self):
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        started.append(executor)
+        return executor
+
+    monkeypatch.setattr(TaggerPool, "_start_executor", start_executor)
+    tagger_pool = TaggerPool("model", "tags", workers=2, chunk_size=2)
+    tagger_pool.started = started
+    yield tagger_pool
+    tagger_pool.shutdown()
+    for executor in started:
+        executor.shutdown()
+
+
+def expected(sentences):
+    return [(sentence.encode("utf-8"), b"doc") for sentence in sentences]
+
+
+def test_tags_in_order(tagger_pool):
+    sentences = [str(i) for i in range(7)]
+    assert list(tagger_pool.tag(sentences)) == expected(sentences)
+
+
+@pytest.mark.parametrize("fail_submit", [False, True])
+def test_broken_pool_is_replaced(tagger_pool, fail_submit):
+    broken = tagger_pool.executor = BrokenExecutor(fail_submit)
+    sentences = [str(i) for i in range(5)]
+
+    assert list(tagger_pool.tag(sentences)) == expected(sentences)
+    assert broken.is_shutdown
+    # Every chunk failed on the broken executor, but it is only replaced once
+    assert len(tagger_pool.started) == 2
+    assert tagger_pool.executor is tagger_pool.started[-1]
+    assert list(tagger_pool.tag(sentences)) == expected(sentences)
+
+
+def test_chunks_are_retried_once(tagger_pool, monkeypatch):
+    monkeypatch.setattr(TaggerPool, "_start_executor", lambda self: BrokenExecutor())
+    tagger_pool.executor = BrokenExecutor()
+
+    with pytest.raises(BrokenProcessPool):
+        list(tagger_pool.tag(["a", "b"]))
+
+
+def test_warm_up_reaches_every_worker(tagger_pool, monkeypatch):
+    # The first worker takes the first two chunks before the second worker answers
+    pids = iter([1, 1, 2])
+    tagged = []
+
+    def warm_up_chunk(sentences):
+        tagged.append(sentences)
+        return next(pids)
+
+    monkeypatch.setattr(pool, "warm_up_chunk", warm_up_chunk)
+    tagger_pool.warm_up(["a"])
+    assert len(tagged) == 3
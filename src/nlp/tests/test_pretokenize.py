@@ -0,0 +1,78 @@
+import pytest
+
+spacy = pytest.importorskip("spacy")
+
+from pretokenize import CodeTokenizer, pretoken_tag
+
+
+@pytest.fixture(scope="module")
+def code_tokenizer():
+    # Tokenizer rules are shared by all English pipelines, so no model needs to be installed
+    return CodeTokenizer(spacy.blank("en").tokenizer)
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Returns `true` if `a == b`.", ["Returns", "`true`", "if", "`a == b`", "."]),
+        ('Prints "hello world".', ["Prints", '"hello world"', "."]),
+        ("Counts 'a' chars", ["Counts", "'a'", "chars"]),
+        ("a!=b.", ["a", "!=", "b", "."]),
+        ("x && y || z", ["x", "&&", "y", "||", "z"]),
+        ("by 3.5f32.", ["by", "3.5f32", "."]),
+        ("3-4", ["3", "-", "4"]),
+        ("1.2.3", ["1.2.3"]),
+        ("1,000 and 2u32", ["1,000", "and", "2u32"]),
+    ],
+)
+def test_tokens(code_tokenizer, text, expected):
+    assert [token.text for token in code_tokenizer(text)] == expected
+
+
+def test_literals_followed_by_punctuation(code_tokenizer):
+    # A literal is a single token whether or not punctuation follows it
+    assert [token.text for token in code_tokenizer("by 2u32, or (3_000).")] == [
+        "by",
+        "2u32",
+        ",",
+        "or",
+        "(",
+        "3_000",
+        ")",
+        ".",
+    ]
+    assert [token.text for token in code_tokenizer("by 2u32 or 3_000")] == [
+        "by",
+        "2u32",
+        "or",
+        "3_000",
+    ]
+
+
+@pytest.mark.parametrize(
+    "text", ["Returns `x` if `a != b`.", 'Says "hi" && "bye"', "  spaced   out  "]
+)
+def test_text_is_preserved(code_tokenizer, text):
+    assert code_tokenizer(text).text == text
+
+
+def test_falls_back_to_base_tokenizer(code_tokenizer):
+    text = "Removes the last element."
+    assert [token.text for token in code_tokenizer(text)] == [
+        token.text for token in code_tokenizer.base(text)
+    ]
+
+
+@pytest.mark.parametrize(
+    "text, tag",
+    [
+        ("`x`", "CODE"),
+        ('"s"', "STR"),
+        ("'c'", "CHAR"),
+        ("==", "BOOL_OP"),
+        ("5", None),
+        ("x", None),
+    ],
+)
+def test_pretoken_tag(text, tag):
+    assert pretoken_tag(text) == tag
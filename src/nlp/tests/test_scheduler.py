@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+from scheduler import BatchScheduler
+
+
+class RecordingTagger:
+    """Tags sentences by uppercasing them, recording each batch. Batches wait for `release`, so that
+    tests can submit sentences while a batch is in flight."""
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, batch):
+        self.batches.append(list(batch))
+        self.release.wait()
+        return [sentence.upper() for sentence in batch]
+
+
+@pytest.fixture
+def tagger():
+    return RecordingTagger()
+
+
+@pytest.fixture
+def scheduler(tagger):
+    scheduler = BatchScheduler(tagger, max_batch=4, max_wait=0.05)
+    yield scheduler
+    tagger.release.set()
+    scheduler.shutdown()
+
+
+def test_results_in_order(scheduler):
+    futures = scheduler.submit(["a", "b", "c"])
+    assert [future.result(timeout=5) for future in futures] == ["A", "B", "C"]
+
+
+def test_batches_are_bounded(scheduler, tagger):
+    futures = scheduler.submit([str(i) for i in range(10)])
+    for future in futures:
+        future.result(timeout=5)
+    assert all(len(batch) <= 4 for batch in tagger.batches)
+    assert sum(len(batch) for batch in tagger.batches) == 10
+    assert scheduler.stats()["sentences"] == 10
+
+
+def test_pending_sentences_are_tagged_once(scheduler, tagger):
+    tagger.release.clear()
+    first = scheduler.submit(["a", "b"])
+    second = scheduler.submit(["b", "a"])
+    assert first[0] is second[1]
+    assert first[1] is second[0]
+
+    tagger.release.set()
+    assert [future.result(timeout=5) for future in second] == ["B", "A"]
+    tagged = [sentence for batch in tagger.batches for sentence in batch]
+    assert sorted(tagged) == ["a", "b"]
+    assert scheduler.stats()["pending"] == 0
+
+
+def test_errors_reach_every_caller():
+    def fail(batch):
+        raise ValueError("tagger failed")
+
+    scheduler = BatchScheduler(fail, max_wait=0.01)
+    try:
+        futures = scheduler.submit(["a", "b"])
+        for future in futures:
+            with pytest.raises(ValueError, match="tagger failed"):
+                future.result(timeout=5)
+        assert scheduler.stats()["pending"] == 0
+
+        # Failed sentences are no longer pending, so they are tagged again when resubmitted
+        (future,) = scheduler.submit(["a"])
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+    finally:
+        scheduler.shutdown()
+
+
+def test_short_results_fail_the_rest():
+    scheduler = BatchScheduler(lambda batch: ["first"], max_wait=0.01)
+    try:
+        first, second = scheduler.submit(["a", "b"])
+        assert first.result(timeout=5) == "first"
+        with pytest.raises(RuntimeError):
+            second.result(timeout=5)
+    finally:
+        scheduler.shutdown()
+
+
+def test_shutdown_finishes_pending_batches(tagger):
+    scheduler = BatchScheduler(tagger, max_wait=0.01)
+    futures = scheduler.submit(["a", "b"])
+    scheduler.shutdown()
+    assert [future.result(timeout=5) for future in futures] == ["A", "B"]
@@ -0,0 +1,164 @@
+import threading
+
+from store import (INDEX_ENTRY, RECORD_HEADER, VERSION_FILE, SegmentStore,
+                   sentence_key)
+
+
+def payload(i: int) -> bytes:
+    return f"sentence {i}".encode("utf-8") * 4
+
+
+def fill(store: SegmentStore, n: int):
+    for i in range(n):
+        store.put(sentence_key(str(i)), payload(i))
+    store.flush()
+
+
+def assert_holds(store: SegmentStore, n: int):
+    assert len(store) == n
+    for i in range(n):
+        assert store.get(sentence_key(str(i))) == payload(i)
+
+
+def test_put_get(tmp_path):
+    store = SegmentStore(tmp_path)
+    key = sentence_key("a")
+    assert store.get(key) is None
+    assert store.put(key, b"payload")
+    assert not store.put(key, b"other")
+    assert key in store
+    assert store.get(key) == b"payload"
+
+
+def test_reopen(tmp_path):
+    store = SegmentStore(tmp_path)
+    fill(store, 50)
+    store.close()
+
+    assert_holds(SegmentStore(tmp_path), 50)
+
+
+def test_reopen_without_close(tmp_path):
+    # Flushed records survive a crash, which leaves the active segment open
+    fill(SegmentStore(tmp_path), 50)
+
+    assert_holds(SegmentStore(tmp_path), 50)
+
+
+def test_each_process_writes_a_new_segment(tmp_path):
+    for i in range(3):
+        store = SegmentStore(tmp_path)
+        store.put(sentence_key(str(i)), payload(i))
+        store.close()
+
+    store = SegmentStore(tmp_path)
+    assert len(store.segments) == 3
+    assert_holds(store, 3)
+
+
+def test_compacts_sealed_segments(tmp_path):
+    store = SegmentStore(tmp_path, segment_bytes=256, max_segments=2)
+    fill(store, 200)
+    assert len(store._sealed()) <= 2
+    assert_holds(store, 200)
+    store.close()
+
+    store = SegmentStore(tmp_path, segment_bytes=256, max_segments=2)
+    assert_holds(store, 200)
+    assert len(list(tmp_path.glob("*.tmp"))) == 0
+
+
+def test_compacts_on_open(tmp_path):
+    for i in range(4):
+        store = SegmentStore(tmp_path, max_segments=2)
+        store.put(sentence_key(str(i)), payload(i))
+        store.close()
+
+    store = SegmentStore(tmp_path, max_segments=2)
+    # Four segments were written, and merged once more than two existed
+    assert len(store.segments) <= 2
+    assert_holds(store, 4)
+
+
+def test_compaction_keeps_concurrent_writes(tmp_path):
+    store = SegmentStore(tmp_path, segment_bytes=512, max_segments=2)
+    errors = []
+
+    def write(start: int):
+        try:
+            for i in range(start, start + 200):
+                store.put(sentence_key(str(i)), payload(i))
+                assert store.get(sentence_key(str(i))) == payload(i)
+        except AssertionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(i * 200,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    store.flush()
+    assert_holds(store, 800)
+    store.close()
+    assert_holds(SegmentStore(tmp_path, segment_bytes=512, max_segments=2), 800)
+
+
+def test_torn_record_is_truncated(tmp_path):
+    store = SegmentStore(tmp_path)
+    fill(store, 10)
+    store.close()
+
+    (segment,) = tmp_path.glob("*.seg")
+    size = segment.stat().st_size
+    with open(segment, "ab") as f:
+        f.write(RECORD_HEADER.pack(sentence_key("torn"), 100))
+        f.write(b"partial")
+
+    store = SegmentStore(tmp_path)
+    assert segment.stat().st_size == size
+    assert sentence_key("torn") not in store
+    assert_holds(store, 10)
+
+
+def test_unindexed_records_are_recovered(tmp_path):
+    store = SegmentStore(tmp_path)
+    fill(store, 10)
+    store.close()
+
+    # The process crashed before flushing the index of the last 4 records
+    (segment,) = tmp_path.glob("*.seg")
+    index = segment.with_suffix(".idx")
+    with open(index, "r+b") as f:
+        f.truncate(6 * INDEX_ENTRY.size)
+
+    store = SegmentStore(tmp_path)
+    assert_holds(store, 10)
+    assert index.stat().st_size == 10 * INDEX_ENTRY.size
+
+
+def test_corrupted_record_is_discarded(tmp_path):
+    store = SegmentStore(tmp_path)
+    key = sentence_key("a")
+    store.put(key, b"payload")
+    store.close()
+
+    (segment,) = tmp_path.glob("*.seg")
+    data = bytearray(segment.read_bytes())
+    data[RECORD_HEADER.size] ^= 0xFF
+    segment.write_bytes(bytes(data))
+
+    # The checksum no longer matches, so the record is dropped when it is read
+    store = SegmentStore(tmp_path)
+    assert store.get(key) is None
+
+
+def test_other_version_is_discarded(tmp_path):
+    store = SegmentStore(tmp_path, version=1)
+    fill(store, 5)
+    store.close()
+
+    store = SegmentStore(tmp_path, version=2)
+    assert len(store) == 0
+    assert (tmp_path / VERSION_FILE).read_text() == "2"
@@ -0,0 +1,94 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from store import sentence_key
+from vector_index import INDEX_FILE, VectorIndex
+
+
+def add(index: VectorIndex, text: str, vector):
+    return index.add(sentence_key(text), text, np.array(vector, dtype="f4"))
+
+
+def test_search_ranks_by_cosine_similarity(tmp_path):
+    index = VectorIndex(tmp_path, 2)
+    add(index, "east", [1, 0])
+    add(index, "north", [0, 3])
+    add(index, "north east", [2, 2])
+
+    results = index.search(np.array([1, 0.1]), k=2)
+    assert [text for text, _ in results] == ["east", "north east"]
+    assert results[0][1] == pytest.approx(0.995, abs=1e-3)
+
+
+def test_search_excludes_keys(tmp_path):
+    index = VectorIndex(tmp_path, 2)
+    add(index, "east", [1, 0])
+    add(index, "north east", [1, 1])
+
+    results = index.search(np.array([1, 0]), k=1, exclude={sentence_key("east")})
+    assert [text for text, _ in results] == ["north east"]
+
+
+def test_search_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr("vector_index.SEARCH_BLOCK", 3)
+    index = VectorIndex(tmp_path, 2)
+    for i in range(10):
+        add(index, str(i), [1, i])
+
+    results = index.search(np.array([1, 9]), k=3)
+    assert [text for text, _ in results] == ["9", "8", "7"]
+
+
+def test_keys_are_added_once(tmp_path):
+    index = VectorIndex(tmp_path, 2)
+    assert add(index, "east", [1, 0])
+    assert not add(index, "east", [0, 1])
+    assert len(index) == 1
+
+
+def test_sentences_without_vectors_are_seen(tmp_path):
+    index = VectorIndex(tmp_path, 2)
+    assert not index.add(sentence_key("none"), "none", None)
+    assert not add(index, "zero", [0, 0])
+    index.flush()
+
+    index = VectorIndex(tmp_path, 2)
+    assert len(index) == 0
+    assert index.is_seen(sentence_key("none"))
+    assert index.is_seen(sentence_key("zero"))
+    assert index.seen == 2
+
+
+def test_reload(tmp_path):
+    index = VectorIndex(tmp_path, 2)
+    add(index, "east", [1, 0])
+    add(index, "north", [0, 1])
+    index.close()
+
+    index = VectorIndex(tmp_path, 2)
+    assert len(index) == 2
+    assert index.search(np.array([0, 1]), k=1)[0][0] == "north"
+
+
+def test_torn_entry_is_truncated(tmp_path):
+    index = VectorIndex(tmp_path, 2)
+    add(index, "east", [1, 0])
+    index.close()
+
+    path = tmp_path / INDEX_FILE
+    size = path.stat().st_size
+    with open(path, "ab") as f:
+        f.write(b"\x00" * 7)
+
+    index = VectorIndex(tmp_path, 2)
+    assert len(index) == 1
+    assert path.stat().st_size == size
+
+
+def test_other_width_is_discarded(tmp_path):
+    index = VectorIndex(tmp_path, 2)
+    add(index, "east", [1, 0])
+    index.close()
+
+    assert len(VectorIndex(tmp_path, 3)) == 0
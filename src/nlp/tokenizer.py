@@ -1,45 +1,132 @@
 import io
 import logging
+import struct
 import sys
+import threading
 from collections import defaultdict
 from enum import Enum
-from functools import cached_property
+from functools import cached_property, partial
 from io import BytesIO
+from os import getenv
 from pathlib import Path
-from typing import Dict, Iterable, List, Union
+from typing import (Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple,
+                    Union)
 
 import msgpack
 import numpy as np
 import spacy
 import unidecode
-from spacy.tokens import Doc, DocBin
+from spacy.tokens import Doc
 
 try:
+    from cache import (CachePerModel, EvictionPolicy, deep_sizeof, env_bytes,
+                       make_cache)
     from fix_tokens import fix_tokens
-    from ner import ner_and_srl
+    from pool import TaggerPool
+    from pretokenize import CodeTokenizer
+    from scheduler import BatchScheduler
+    from store import SegmentStore, sentence_key
+    from vector_index import VectorIndex
 except ModuleNotFoundError:
+    from .cache import (CachePerModel, EvictionPolicy, deep_sizeof, env_bytes,
+                        make_cache)
     from .fix_tokens import fix_tokens
-    from .ner import ner_and_srl
+    from .pool import TaggerPool
+    from .pretokenize import CodeTokenizer
+    from .scheduler import BatchScheduler
+    from .store import SegmentStore, sentence_key
+    from .vector_index import VectorIndex
 
 LOGGER = logging.getLogger(__name__)
 
 if not Doc.has_extension("raw_text"):
     Doc.set_extension("raw_text", default=None)
 
+if not Doc.has_extension("doc_vec"):
+    Doc.set_extension("doc_vec", default=None)
+
+
+# Records in the token store hold the length of the msgpack payload, the msgpack payload
+# served by /tokenize, and the serialized Doc. Version 3 tokenizes code spans and literals up front.
+# Since version 3, the lemma of a code span, string, char or boolean operator is its text - previously,
+# these were merged from several tokens, and their lemma was the concatenation of those tokens' lemmas.
+STORE_VERSION = 3
+# Smaller batches reduce the time until the first sentence of a streamed response is available
+PIPE_BATCH_SIZE = int(getenv("PIPE_BATCH_SIZE", 256))
+RECORD_PREFIX = struct.Struct("<I")
+
+
+def pack_record(payload: bytes, doc_bytes: bytes) -> bytes:
+    return b"".join((RECORD_PREFIX.pack(len(payload)), payload, doc_bytes))
+
+
+def unpack_record(record: bytes) -> Tuple[bytes, bytes]:
+    """Returns the msgpack payload and serialized Doc stored in the record."""
+    (payload_len,) = RECORD_PREFIX.unpack_from(record)
+    start = RECORD_PREFIX.size
+    return record[start : start + payload_len], record[start + payload_len :]
+
+
+def msgpack_to_json(payload: bytes) -> dict:
+    """Converts the msgpack payload of a sentence to the output of `Sentence.json`, without
+    loading the sentence's Doc."""
+    values = msgpack.unpackb(payload)
+    values["tokens"] = [
+        {"tag": tag, "text": text, "lemma": lemma}
+        for tag, text, lemma in values["tokens"]
+    ]
+    if "vector" in values:
+        values["vector"] = np.frombuffer(values["vector"], dtype="<f4").tolist()
+    return values
+
+
+def host_vector(doc: Doc) -> np.ndarray:
+    """Returns the Doc's vector, copied to host memory if spaCy is using the GPU."""
+    vector = doc.vector
+    return vector if isinstance(vector, np.ndarray) else vector.get()
+
+
+def payload_vector(payload: bytes) -> Tuple[str, Optional[np.ndarray]]:
+    """Returns the text and vector (if any) held in the msgpack payload of a sentence."""
+    values = msgpack.unpackb(payload)
+    vector = values.get("vector")
+    if vector is not None:
+        vector = np.frombuffer(vector, dtype="<f4")
+    return values["text"], vector
+
+
+def cache_path(model) -> str:
+    """The location of the on-disk stores used by the server for the given model."""
+    return f"./cache/{model}"
+
 
 def is_quote(word: str) -> bool:
     return word[0] in "\"'`"
 
 
+class materialized(cached_property):
+    """A `cached_property` of a sentence which calls the sentence's `resize` hook once computed, so that
+    the cache holding the sentence can account for the memory it uses."""
+
+    def __get__(self, instance, owner=None):
+        value = super().__get__(instance, owner)
+        if instance is not None and instance.resize is not None:
+            instance.resize()
+        return value
+
+
 class Sentence:
+    # Set by the token cache holding the sentence, to re-measure it as it builds lazy attributes
+    resize: Optional[Callable[[], None]] = None
+
     def __init__(self, doc: Doc):
         self.doc = doc
 
-    @cached_property
+    @materialized
     def metadata(self):
         return tuple((token.tag_, token.text, token.lemma_) for token in self.doc)
 
-    @cached_property
+    @materialized
     def msgpack(self):
         data = BytesIO()
 
@@ -66,9 +153,13 @@ class Sentence:
             data.write(len(vec).to_bytes(2, byteorder="big"))
             data.write(vec)
 
-        return data.getbuffer()
+        return data.getvalue()
 
-    @cached_property
+    def vector(self) -> Optional[np.ndarray]:
+        """Returns the sentence's vector in host memory, or None if the model has no word vectors."""
+        return host_vector(self.doc) if self.doc.has_vector else None
+
+    @materialized
     def json(self):
         values = {
             "text": self.doc.text,
@@ -85,6 +176,57 @@ class Sentence:
         return values
 
 
+class StoredSentence(Sentence):
+    """A sentence read from a serialized record (eg. from the on-disk store, or a tagging worker).
+    The msgpack payload is available immediately, while the Doc is only deserialized when first used."""
+
+    def __init__(
+        self, payload: bytes, doc_bytes: bytes, load_doc: Callable[[bytes], Doc]
+    ):
+        self.msgpack = payload
+        self.doc_bytes = doc_bytes
+        self.load_doc = load_doc
+
+    @materialized
+    def doc(self) -> Doc:
+        doc = self.load_doc(self.doc_bytes)
+        self.doc_bytes = None
+        return doc
+
+    def vector(self) -> Optional[np.ndarray]:
+        # The payload holds the same vector, so the Doc is not loaded just to read it
+        if "doc" in self.__dict__:
+            return super().vector()
+        return payload_vector(self.msgpack)[1]
+
+    @materialized
+    def metadata(self):
+        # The payload holds the same (tag, text, lemma) tuples, without loading the Doc
+        return tuple(tuple(token) for token in msgpack.unpackb(self.msgpack)["tokens"])
+
+
+# Rough per-token overhead of a Doc (TokenC struct, lexeme pointers, strings)
+TOKEN_BYTES = 256
+
+
+def sentence_sizeof(sentence: Sentence) -> int:
+    """Approximates the memory held by a cached sentence, including its tensor and vector, and any
+    lazily built attributes. Sentences are re-measured as they build attributes (see `materialized`)."""
+    if "doc" not in sentence.__dict__:
+        size = len(sentence.doc_bytes)
+    else:
+        doc = sentence.doc
+        size = 2 * len(doc.text) + TOKEN_BYTES * len(doc)
+        if doc.tensor is not None:
+            size += doc.tensor.nbytes
+        if doc.has_vector:
+            size += doc.vector.nbytes
+    for cached in ("metadata", "msgpack", "json"):
+        if cached in sentence.__dict__:
+            size += deep_sizeof(sentence.__dict__[cached])
+    return size
+
+
 class SpacyModel(str, Enum):
     EN_SM = "en_core_web_sm"
     EN_MD = "en_core_web_md"
@@ -95,85 +237,248 @@ class SpacyModel(str, Enum):
         return self.value
 
 
-class Tokenizer:
-    TOKEN_CACHE: Dict[SpacyModel, Dict[str, Sentence]] = defaultdict(dict)
-    ENTITY_CACHE = defaultdict(dict)
-    TAGGER_CACHE = {}
-    CACHE_LOADED = defaultdict(set)
+class PipelineProfile(str, Enum):
+    """The components run by a tagger. `TAGS` excludes the components which do not contribute
+    to the tags, lemmas and vectors returned by /tokenize."""
 
-    def __init__(self, model: SpacyModel = SpacyModel.EN_LG):
-        self.token_cache = Tokenizer.TOKEN_CACHE[model]
-        self.entity_cache = Tokenizer.ENTITY_CACHE[model]
-        self.tagger = self.load_tagger(model)
+    FULL = "full"
+    TAGS = "tags"
 
-    @classmethod
-    def load_tagger(cls, model: SpacyModel):
-        if model not in cls.TAGGER_CACHE:
-            spacy.prefer_gpu(0)
-            LOGGER.info(f"Loading spacy/{model}")
-            nlp = spacy.load(str(model))
-            nlp.add_pipe("doc_tokens")
-            cls.TAGGER_CACHE[model] = nlp
-        return cls.TAGGER_CACHE[model]
+    def __str__(self):
+        return self.value
+
+    @property
+    def excluded(self) -> List[str]:
+        return PROFILE_EXCLUDES[self]
 
-    @classmethod
-    def from_cache(cls, path: Union[Path, str], model: SpacyModel = SpacyModel.EN_LG):
-        if path in cls.CACHE_LOADED[model]:
-            LOGGER.info(f"Path {path} already cached.")
-            return Tokenizer(model)
 
-        tagger = cls.load_tagger(model)
-        has_vec = "tok2vec" in tagger.pipe_names
-        if has_vec:
-            Doc.set_extension("doc_vec", default=None)
+PROFILE_EXCLUDES = {
+    PipelineProfile.FULL: [],
+    PipelineProfile.TAGS: ["parser", "ner"],
+}
 
-        try:
-            docs = DocBin(store_user_data=True).from_disk(path).get_docs(tagger.vocab)
-            docs = [(doc._.raw_text, doc) for doc in docs]
-            if has_vec:
-                for (_, doc) in docs:
-                    doc._vector = np.array(doc._.doc_vec)
 
-            cls.TOKEN_CACHE[model].update((text, Sentence(doc)) for text, doc in docs)
-            cls.CACHE_LOADED[model].add(path)
-        except FileNotFoundError:
-            pass
+def default_profile() -> PipelineProfile:
+    """The profile used by requests which do not specify one, set by PIPELINE_PROFILE."""
+    return PipelineProfile(getenv("PIPELINE_PROFILE", PipelineProfile.TAGS))
 
-        if has_vec:
-            Doc.remove_extension("doc_vec")
 
-        return Tokenizer(model)
+class Pipeline(NamedTuple):
+    """Identifies a tagger, and the caches and stores holding its output."""
 
-    def write_data(self, path: Union[Path, str]):
-        doc_bin = DocBin(store_user_data=True)
+    model: SpacyModel
+    profile: PipelineProfile
 
-        has_vec = "tok2vec" in self.tagger.pipe_names
+    def __str__(self):
+        return f"{self.model}/{self.profile}"
 
-        if has_vec:
-            Doc.set_extension("doc_vec", default=None)
 
-        for sent in self.token_cache.values():
-            if has_vec:
-                sent.doc._.doc_vec = sent.doc.vector
-            doc_bin.add(sent.doc)
+def cache_budget(prefix: str, model: SpacyModel, default: int):
+    """Reads the memory budget for each of the given model's caches, eg. TOKEN_CACHE_SIZE_EN_CORE_WEB_LG,
+    falling back to TOKEN_CACHE_SIZE, and then `default`. Token caches are kept per pipeline, so each
+    profile of the model has a cache with this budget."""
+    return env_bytes(f"{prefix}_{str(model).upper()}", env_bytes(prefix, default))
 
-        if isinstance(path, Path):
-            path.parent.mkdir(exist_ok=True, parents=True)
-        else:
-            Path(path).parent.mkdir(exist_ok=True, parents=True)
-        doc_bin.to_disk(path)
 
-        if has_vec:
-            Doc.remove_extension("doc_vec")
+def token_cache(pipeline: Pipeline):
+    return make_cache(
+        cache_budget("TOKEN_CACHE_SIZE", pipeline.model, 512 * 2**20),
+        EvictionPolicy(getenv("CACHE_POLICY", EvictionPolicy.LRU)),
+        sentence_sizeof,
+    )
+
+
+class Tokenizer:
+    # Tokens, taggers and token stores are kept per pipeline, vector indexes per model
+    TOKEN_CACHE: Dict[Pipeline, Dict[str, Sentence]] = CachePerModel(token_cache)
+    TAGGER_CACHE: Dict[Pipeline, spacy.Language] = {}
+    CACHE_LOADED = defaultdict(set)
+    STORES: Dict[Pipeline, SegmentStore] = {}
+    POOLS: Dict[Pipeline, TaggerPool] = {}
+    SCHEDULERS: Dict[Pipeline, BatchScheduler] = {}
+    VECTOR_INDEXES: Dict[SpacyModel, VectorIndex] = {}
+    # Held while loading taggers and opening stores, which may happen concurrently during warm-up
+    LOAD_LOCK = threading.RLock()
+
+    def __init__(
+        self,
+        model: SpacyModel = SpacyModel.EN_LG,
+        profile: Optional[PipelineProfile] = None,
+    ):
+        self.model = model
+        self.profile = PipelineProfile(profile or default_profile())
+        self.pipeline = Pipeline(model, self.profile)
+        self.token_cache = Tokenizer.TOKEN_CACHE[self.pipeline]
+        self.tagger = self.load_tagger(model, self.profile)
+        self.store = Tokenizer.STORES.get(self.pipeline)
+        self.vector_index = Tokenizer.VECTOR_INDEXES.get(model)
+
+    @classmethod
+    def load_tagger(cls, model: SpacyModel, profile: PipelineProfile):
+        pipeline = Pipeline(model, profile)
+        # Loaded taggers are never replaced, so the lock is only needed to load them
+        tagger = cls.TAGGER_CACHE.get(pipeline)
+        if tagger is not None:
+            return tagger
+        with cls.LOAD_LOCK:
+            if pipeline not in cls.TAGGER_CACHE:
+                spacy.prefer_gpu(0)
+                LOGGER.info(f"Loading spacy/{model} ({profile})")
+                nlp = spacy.load(str(model), exclude=profile.excluded)
+                nlp.tokenizer = CodeTokenizer(nlp.tokenizer)
+                nlp.add_pipe("doc_tokens")
+                cls.TAGGER_CACHE[pipeline] = nlp
+            return cls.TAGGER_CACHE[pipeline]
+
+    @classmethod
+    def from_cache(
+        cls,
+        path: Union[Path, str],
+        model: SpacyModel = SpacyModel.EN_LG,
+        profile: Optional[PipelineProfile] = None,
+    ):
+        """Opens the on-disk token store at `path` (a directory), or at `{path}-{profile}` for profiles
+        other than `FULL`. Only the store's index is read here - sentences are loaded from the store into
+        the token cache when they are first requested. Newly tokenized sentences are appended to the store
+        as they are produced.
+        A legacy DocBin cache at `{path}.spacy` is not imported, as it was tokenized by an older
+        version - it is renamed to `{path}.spacy.outdated`.
+        For models with word vectors, sentence vectors are added to a `VectorIndex` at `{path}-vectors`,
+        which is backfilled from the token store when opened.
+        If TAGGER_WORKERS is set, sentences are tagged by a pool of that many worker processes.
+        Sentences from concurrent callers are coalesced into batches of up to BATCH_MAX_SIZE sentences,
+        waiting at most BATCH_MAX_WAIT_MS for a batch to fill (BATCH_MAX_SIZE=0 disables batching). With a
+        pool, up to TAGGER_WORKERS batches are tagged at once."""
+        pipeline = Pipeline(model, PipelineProfile(profile or default_profile()))
+        if path in cls.CACHE_LOADED[pipeline]:
+            LOGGER.info(f"Path {path} already cached.")
+            return Tokenizer(model, pipeline.profile)
+
+        with cls.LOAD_LOCK:
+            # Another thread may have opened the store while this thread waited for the lock
+            if path in cls.CACHE_LOADED[pipeline]:
+                return Tokenizer(model, pipeline.profile)
+
+            cls.load_tagger(model, pipeline.profile)
+            store_path = path
+            if pipeline.profile != PipelineProfile.FULL:
+                store_path = f"{path}-{pipeline.profile}"
+            cls.STORES[pipeline] = SegmentStore(store_path, version=STORE_VERSION)
+            width = cls.TAGGER_CACHE[pipeline].vocab.vectors.shape[1]
+            if width and model not in cls.VECTOR_INDEXES:
+                cls.VECTOR_INDEXES[model] = VectorIndex(f"{path}-vectors", width)
+            workers = int(getenv("TAGGER_WORKERS", 0))
+            if workers and pipeline not in cls.POOLS:
+                cls.POOLS[pipeline] = TaggerPool(model, pipeline.profile, workers)
+
+            max_batch = int(getenv("BATCH_MAX_SIZE", 256))
+            if max_batch and pipeline not in cls.SCHEDULERS:
+                cls.SCHEDULERS[pipeline] = BatchScheduler(
+                    Tokenizer(model, pipeline.profile)._tag_now,
+                    max_batch=max_batch,
+                    max_wait=float(getenv("BATCH_MAX_WAIT_MS", 2)) / 1000,
+                    name=str(pipeline),
+                    concurrency=max(workers, 1),
+                )
+            tokenizer = Tokenizer(model, pipeline.profile)
+
+            # Legacy DocBin caches were tokenized by an older version, so they are set aside rather
+            # than imported
+            legacy_path = Path(f"{path}.spacy")
+            if legacy_path.exists():
+                LOGGER.info(f"Not importing outdated {legacy_path} into {store_path}")
+                legacy_path.rename(
+                    legacy_path.with_name(f"{legacy_path.name}.outdated")
+                )
+
+            cls.CACHE_LOADED[pipeline].add(path)
+
+        # Backfilling reads every stored sentence, so it is done without holding the lock, which would
+        # stop other pipelines from loading in the meantime. The vector index may be searched and added to
+        # while it is backfilled.
+        if tokenizer.vector_index is not None:
+            tokenizer._index_store()
+        return tokenizer
+
+    @cached_property
+    def has_vec(self) -> bool:
+        return "tok2vec" in self.tagger.pipe_names
+
+    def _restore_vector(self, doc: Doc):
+        if self.has_vec and doc._.doc_vec is not None:
+            doc._vector = np.array(doc._.doc_vec)
+
+    def doc_to_bytes(self, doc: Doc) -> bytes:
+        if self.has_vec:
+            doc._.doc_vec = host_vector(doc)
+        return doc.to_bytes(exclude=["tensor"])
+
+    def doc_from_bytes(self, data: bytes) -> Doc:
+        doc = Doc(self.tagger.vocab).from_bytes(data)
+        self._restore_vector(doc)
+        return doc
+
+    def _cache(self, sentence: str, tokenized: Sentence):
+        tokenized.resize = partial(self.token_cache.resize, sentence)
+        self.token_cache[sentence] = tokenized
+
+    def _add(self, sentence: str, doc: Doc) -> Sentence:
+        """Caches the tokenized sentence, and appends it to the on-disk store, if one is open."""
+        doc._.raw_text = sentence
+        tokenized = Sentence(doc)
+        if self.store is not None:
+            key = sentence_key(sentence)
+            if key not in self.store:
+                record = pack_record(tokenized.msgpack, self.doc_to_bytes(doc))
+                self.store.put(key, record)
+        if self.vector_index is not None:
+            vector = host_vector(doc) if doc.has_vector else None
+            self.vector_index.add(sentence_key(sentence), doc.text, vector)
+        self._cache(sentence, tokenized)
+        return tokenized
+
+    def _add_record(self, sentence: str, payload: bytes, doc_bytes: bytes) -> Sentence:
+        """Caches and stores a sentence which was tagged by a worker process."""
+        if self.store is not None:
+            self.store.put(sentence_key(sentence), pack_record(payload, doc_bytes))
+        if self.vector_index is not None:
+            text, vector = payload_vector(payload)
+            self.vector_index.add(sentence_key(sentence), text, vector)
+        tokenized = StoredSentence(payload, doc_bytes, self.doc_from_bytes)
+        self._cache(sentence, tokenized)
+        return tokenized
+
+    def tag_records(self, sentences: List[str]) -> Iterable[Tuple[bytes, bytes]]:
+        """Tags the given sentences, producing a (msgpack payload, serialized Doc) record for each,
+        without caching them."""
+        docs = self.tagger.pipe(
+            (unidecode.unidecode(sentence) for sentence in sentences),
+            batch_size=PIPE_BATCH_SIZE,
+        )
+        for sentence, doc in zip(sentences, docs):
+            doc._.raw_text = sentence
+            yield Sentence(doc).msgpack, self.doc_to_bytes(doc)
+
+    def cached(self, sentence: str) -> Optional[Sentence]:
+        """Looks up the sentence in the token cache, falling back to the on-disk store."""
+        tokenized = self.token_cache.get(sentence)
+        if tokenized is None and self.store is not None:
+            record = self.store.get(sentence_key(sentence))
+            if record is not None:
+                self.token_cache.store_hit()
+                payload, doc_bytes = unpack_record(record)
+                tokenized = StoredSentence(payload, doc_bytes, self.doc_from_bytes)
+                self._cache(sentence, tokenized)
+        return tokenized
 
     def tokenize(self, sentence: str, idents=None) -> Sentence:
         """Tokenizes and tags the given sentence."""
-        if sentence not in self.token_cache:
-            doc = self.tagger(unidecode.unidecode(sentence))
-            doc._.raw_text = sentence
-            self.token_cache[sentence] = Sentence(doc)
+        tokenized = self.cached(sentence)
+        if tokenized is None:
+            (tokenized,) = self._tag([sentence])
+            self.flush()
 
-        return self.token_cache[sentence]
+        return tokenized
 
     def stream_tokenize(self, sentences: List[str], idents=None) -> Iterable[Sentence]:
         """
@@ -182,66 +487,150 @@ class Tokenizer:
         ~2x faster than calling tokenize on an item-by-item basis for 6000 items
         (all unique sentences in stdlib).
         """
-        tokenized_sentences = [self.token_cache.get(sentence) for sentence in sentences]
-        empty_inds = [i for i, val in enumerate(tokenized_sentences) if val is None]
-        new_sents = self.tagger.pipe(
-            unidecode.unidecode(sentences[i]) for i in empty_inds
+        tokenized_sentences = [self.cached(sentence) for sentence in sentences]
+        new_sents = self._tag(
+            [sentences[i] for i, val in enumerate(tokenized_sentences) if val is None]
         )
 
+        for tokenized in tokenized_sentences:
+            yield next(new_sents) if tokenized is None else tokenized
+
+        self.flush()
+
+    def _tag(self, sentences: List[str]) -> Iterable[Sentence]:
+        """Tags all of the given sentences, adding each to the cache. If a batch scheduler is running,
+        sentences are tagged in batches shared with other callers."""
+        scheduler = Tokenizer.SCHEDULERS.get(self.pipeline)
+        if scheduler is None:
+            yield from self._tag_now(sentences)
+            return
+
+        for future in scheduler.submit(sentences):
+            yield future.result()
+
+    def _tag_now(self, sentences: List[str]) -> Iterable[Sentence]:
+        pool = Tokenizer.POOLS.get(self.pipeline)
+        if pool is not None:
+            for sentence, record in zip(sentences, pool.tag(sentences)):
+                yield self._add_record(sentence, *record)
+            return
+
+        docs = self.tagger.pipe(
+            (unidecode.unidecode(sentence) for sentence in sentences),
+            batch_size=PIPE_BATCH_SIZE,
+        )
+        for sentence, doc in zip(sentences, docs):
+            yield self._add(sentence, doc)
+
+    def flush(self):
+        """Flushes newly tokenized sentences to the on-disk store and vector index."""
+        if self.store is not None:
+            self.store.flush()
+        if self.vector_index is not None:
+            self.vector_index.flush()
+
+    def _index_store(self):
+        """Adds the vectors of sentences in the token store which have not been offered to the vector
+        index. Sentences without a vector are recorded by the index, so they are only read once.
+        The index is shared by all profiles of the model, so each key of this profile's store is checked,
+        rather than comparing the number of sentences in the index and the store."""
+        added = 0
+        for key in self.store.keys():
+            if self.vector_index.is_seen(key):
+                continue
+            record = self.store.get(key)
+            if record is None:
+                continue
+            text, vector = payload_vector(unpack_record(record)[0])
+            added += self.vector_index.add(key, text, vector)
+        self.vector_index.flush()
+        LOGGER.info(f"Indexed vectors of {added} stored sentences")
+
+    def similar(self, sentence: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Returns the text and cosine similarity of the `k` tokenized sentences most similar to the
+        given sentence, excluding the sentence itself. Requires a model with word vectors.
+        Queries are tagged without adding them to the token cache, store, or vector index, unless
+        they were already tokenized."""
+        if self.vector_index is None:
+            raise ValueError(f"spacy/{self.model} has no vector index")
+        payload = self._payload(sentence)
+        if payload is not None:
+            _, vector = payload_vector(payload)
+        else:
+            vector = self.tag_uncached(sentence).vector()
+        if vector is None:
+            return []
+        exclude = {sentence_key(sentence)}
+        return self.vector_index.search(vector, k, exclude)
+
+    def tag_uncached(self, sentence: str) -> Sentence:
+        """Tokenizes and tags the sentence without adding it to the token cache, store, or vector index,
+        unless it was already tokenized. Used for queries, which are not worth keeping."""
+        (tokenized,) = self.tag_uncached_many([sentence])
+        return tokenized
+
+    def tag_uncached_many(self, sentences: List[str]) -> List[Sentence]:
+        """Tokenizes and tags each sentence as in `tag_uncached`. Sentences which were not already
+        tokenized are tagged together."""
+        tokenized_sentences = [self.cached(sentence) for sentence in sentences]
+        docs = self.tagger.pipe(
+            (
+                unidecode.unidecode(sentence)
+                for sentence, tokenized in zip(sentences, tokenized_sentences)
+                if tokenized is None
+            ),
+            batch_size=PIPE_BATCH_SIZE,
+        )
         for i, tokenized in enumerate(tokenized_sentences):
             if tokenized is None:
-                tokenized = next(new_sents)
-                sent = sentences[i]
-                tokenized._.raw_text = sent
-                tokenized = Sentence(tokenized)
-                self.token_cache[sent] = tokenized
-            yield tokenized
-
-    def entities(self, sentence: str) -> dict:
-        """Performs NER and SRL analysis of the given sentence, using the models from
-        `Combining Formal and Machine Learning Techniques for the Generation of JML Specifications`.
-        Output is a dictionary, containing keys "ner" and "srl", corresponding to the NER and SRL entities,
-        respectively. The items are formatted as either a dictionary or list of dictionaries for spaCy display."""
-        sentence = unidecode.unidecode(sentence).rstrip(".")
-
-        if sentence not in self.entity_cache:
-            res = ner_and_srl(sentence)
-            ents = []
-            for item in res["entities"]:
-                ent = {
-                    "start": item["pos"],
-                    "end": item["pos"] + len(item["text"]),
-                    "label": item["type"],
-                }
-                ents.append(ent)
-
-            spacy_ner = {"text": sentence, "ents": ents}
-
-            spacy_srls = []
-            for item in res["predicates"]:
-                ents = []
-                predicate = item["predicate"]
-                predicate.pop("len")
-                predicate["start"] = predicate.pop("pos")
-                predicate["end"] = len(predicate.pop("text")) + predicate["start"]
-                predicate["label"] = "PRED"
-                ents.append(predicate)
-                for label, metadata in item["roles"].items():
-                    ent = {
-                        "start": metadata["pos"],
-                        "end": metadata["pos"] + len(metadata["text"]),
-                        "label": label,
-                    }
-                    ents.append(ent)
-                spacy_srl = {"text": sentence, "ents": ents}
-                spacy_srls.append(spacy_srl)
-
-            if not spacy_srls:
-                spacy_srls.append({"text": sentence, "ents": []})
-
-            self.entity_cache[sentence] = {"ner": spacy_ner, "srl": spacy_srls}
-
-        return self.entity_cache[sentence]
+                doc = next(docs)
+                doc._.raw_text = sentences[i]
+                tokenized_sentences[i] = Sentence(doc)
+        return tokenized_sentences
+
+    def _is_stored(self, sentence: str) -> bool:
+        if sentence in self.token_cache:
+            return True
+        return self.store is not None and sentence_key(sentence) in self.store
+
+    def _payload(self, sentence: str) -> Optional[bytes]:
+        tokenized = self.token_cache.get(sentence)
+        if tokenized is not None:
+            return tokenized.msgpack
+        if self.store is not None:
+            record = self.store.get(sentence_key(sentence))
+            if record is not None:
+                self.token_cache.store_hit()
+                return unpack_record(record)[0]
+        return None
+
+    def stream_msgpack(self, sentences: List[str]) -> Iterable[bytes]:
+        """
+        Produces the msgpack encoding of each sentence (as in `Sentence.msgpack`), in order of their
+        appearance in the input. Payloads of sentences in the on-disk store are copied directly from the store,
+        without loading the sentence's Doc. Payloads are read lazily, so only the payload currently being
+        yielded is held in memory.
+        """
+        stored = [self._is_stored(sentence) for sentence in sentences]
+        new_sents = self._tag(
+            [sentence for sentence, known in zip(sentences, stored) if not known]
+        )
+
+        for sentence, is_stored in zip(sentences, stored):
+            if not is_stored:
+                yield next(new_sents).msgpack
+                continue
+            payload = self._payload(sentence)
+            # The sentence may have been evicted from the token cache since it was checked
+            yield payload if payload is not None else self.tokenize(sentence).msgpack
+
+        self.flush()
+
+    def stream_json(self, sentences: List[str]) -> Iterable[dict]:
+        """Produces the JSON encoding of each sentence (as in `Sentence.json`), in order of their
+        appearance in the input. Like `stream_msgpack`, this does not load Docs from the on-disk store."""
+        for payload in self.stream_msgpack(sentences):
+            yield msgpack_to_json(payload)
 
 
 # confusing examples: log fns, trig fns, pow fns
@@ -0,0 +1,220 @@
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import BinaryIO, Collection, List, Optional, Tuple, Union
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# Vector width, written once at the start of the index file
+INDEX_HEADER = struct.Struct("<I")
+# key (hash of sentence, as in store.sentence_key), length of the sentence's text, followed by
+# the text, and the unit-length vector as little-endian float32s
+ENTRY_HEADER = struct.Struct("<16sI")
+INDEX_FILE = "vectors.idx"
+# Keys of sentences without a (non-zero) vector, so that they are not rescanned when backfilling
+NO_VECTOR_FILE = "novector.keys"
+KEY_SIZE = 16
+# Rows scored per matrix product - bounds the memory used by a search over a large index
+SEARCH_BLOCK = 65536
+
+
+class VectorIndex:
+    """An exact nearest-neighbour index over sentence vectors, scoring queries by cosine similarity.
+
+    Vectors are normalized when added, and held in a single matrix, which is searched in blocks of
+    SEARCH_BLOCK rows. Entries are appended to a file in the `path` directory as they are added,
+    so that the index is updated incrementally, and is reloaded on startup. Entries are keyed by
+    sentence key, and each key is only added once. The keys of sentences which have no vector are
+    recorded in a second file, so that `seen` covers every sentence offered to the index.
+    """
+
+    def __init__(self, path: Union[Path, str], width: int):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self.width = width
+        self.lock = threading.Lock()
+        self.keys: List[bytes] = []
+        self.texts: List[str] = []
+        self.key_set = set()
+        self.no_vector = set()
+        self._matrix = np.zeros((1024, width), dtype="<f4")
+        self._file: Optional[BinaryIO] = None
+        self._no_vector_file: Optional[BinaryIO] = None
+        self._load()
+        self._load_no_vector()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self.key_set
+
+    @property
+    def seen(self) -> int:
+        """The number of sentences offered to the index, with or without a vector."""
+        return len(self.key_set) + len(self.no_vector)
+
+    def is_seen(self, key: bytes) -> bool:
+        return key in self.key_set or key in self.no_vector
+
+    def _load(self):
+        index_path = self.path / INDEX_FILE
+        if not index_path.exists():
+            return
+
+        data = index_path.read_bytes()
+        width = None
+        if len(data) >= INDEX_HEADER.size:
+            (width,) = INDEX_HEADER.unpack_from(data)
+        if width != self.width:
+            LOGGER.warning(
+                f"Discarding {index_path}, which has vector width {width} (expected {self.width})"
+            )
+            index_path.unlink()
+            return
+
+        offset = INDEX_HEADER.size
+        vector_size = 4 * self.width
+        while offset + ENTRY_HEADER.size <= len(data):
+            key, text_len = ENTRY_HEADER.unpack_from(data, offset)
+            start = offset + ENTRY_HEADER.size
+            end = start + text_len + vector_size
+            if end > len(data):
+                break
+            text = data[start : start + text_len].decode("utf-8")
+            vector = np.frombuffer(
+                data, dtype="<f4", count=self.width, offset=end - vector_size
+            )
+            self._append(key, text, vector)
+            offset = end
+
+        if offset != len(data):
+            LOGGER.warning(f"Truncating torn entries at end of {index_path}")
+            os.truncate(index_path, offset)
+
+    def _load_no_vector(self):
+        path = self.path / NO_VECTOR_FILE
+        if not path.exists():
+            return
+        data = path.read_bytes()
+        end = len(data) - len(data) % KEY_SIZE
+        for offset in range(0, end, KEY_SIZE):
+            self.no_vector.add(data[offset : offset + KEY_SIZE])
+        if end != len(data):
+            LOGGER.warning(f"Truncating torn key at end of {path}")
+            os.truncate(path, end)
+
+    def _add_no_vector(self, key: bytes):
+        with self.lock:
+            if key in self.no_vector or key in self.key_set:
+                return
+            if self._no_vector_file is None:
+                self._no_vector_file = open(self.path / NO_VECTOR_FILE, "ab")
+            self._no_vector_file.write(key)
+            self.no_vector.add(key)
+
+    def _writer(self) -> BinaryIO:
+        if self._file is None:
+            index_path = self.path / INDEX_FILE
+            is_new = not index_path.exists() or index_path.stat().st_size == 0
+            self._file = open(index_path, "ab")
+            if is_new:
+                self._file.write(INDEX_HEADER.pack(self.width))
+        return self._file
+
+    def _append(self, key: bytes, text: str, unit: np.ndarray):
+        row = len(self.keys)
+        if row == len(self._matrix):
+            # Searches hold a view of the previous matrix, so it is replaced rather than resized
+            grown = np.zeros((2 * len(self._matrix), self.width), dtype="<f4")
+            grown[:row] = self._matrix[:row]
+            self._matrix = grown
+        self._matrix[row] = unit
+        self.keys.append(key)
+        self.texts.append(text)
+        self.key_set.add(key)
+
+    def add(self, key: bytes, text: str, vector: Optional[np.ndarray]) -> bool:
+        """Adds the sentence's vector to the index, unless the key is already present, or the
+        sentence has no vector (or a zero vector), in which case its key is recorded as seen.
+        Returns whether the vector was added."""
+        if key in self.key_set:
+            return False
+        norm = 0
+        if vector is not None:
+            vector = np.asarray(vector, dtype="<f4")
+            norm = np.linalg.norm(vector)
+        if not norm:
+            self._add_no_vector(key)
+            return False
+
+        unit = vector / norm
+        encoded = text.encode("utf-8")
+        with self.lock:
+            if key in self.key_set:
+                return False
+            writer = self._writer()
+            writer.write(ENTRY_HEADER.pack(key, len(encoded)))
+            writer.write(encoded)
+            writer.write(unit.tobytes())
+            self._append(key, text, unit)
+        return True
+
+    def search(
+        self, vector: np.ndarray, k: int = 10, exclude: Collection[bytes] = ()
+    ) -> List[Tuple[str, float]]:
+        """Returns the (text, score) of the `k` entries most similar to `vector`, in descending order
+        of cosine similarity, skipping entries whose key is in `exclude`."""
+        vector = np.asarray(vector, dtype="<f4")
+        norm = np.linalg.norm(vector)
+        with self.lock:
+            count = len(self.keys)
+            matrix = self._matrix[:count]
+            keys = self.keys[:count]
+            texts = self.texts[:count]
+        if not norm or not count or k <= 0:
+            return []
+
+        query = vector / norm
+        take = k + len(exclude)
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype="<f4")
+        for start in range(0, count, SEARCH_BLOCK):
+            scores = matrix[start : start + SEARCH_BLOCK] @ query
+            if len(scores) > take:
+                top = np.argpartition(-scores, take - 1)[:take]
+            else:
+                top = np.arange(len(scores))
+            best_rows = np.concatenate((best_rows, top + start))
+            best_scores = np.concatenate((best_scores, scores[top]))
+            if len(best_scores) > take:
+                keep = np.argpartition(-best_scores, take - 1)[:take]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+
+        results = []
+        for i in np.argsort(-best_scores, kind="stable"):
+            row = best_rows[i]
+            if keys[row] in exclude:
+                continue
+            results.append((texts[row], float(best_scores[i])))
+            if len(results) == k:
+                break
+        return results
+
+    def flush(self):
+        with self.lock:
+            for f in (self._file, self._no_vector_file):
+                if f is not None:
+                    f.flush()
+
+    def close(self):
+        with self.lock:
+            for f in (self._file, self._no_vector_file):
+                if f is not None:
+                    f.close()
+            self._file = None
+            self._no_vector_file = None
@@ -6,7 +6,8 @@ from fastapi.responses import HTMLResponse
 from spacy import displacy
 from spacy.tokens import Doc
 
-from tokenizer import Sentence, Tokenizer
+from ner import EntityAnalyzer
+from tokenizer import PipelineProfile, Sentence, Tokenizer
 
 from .palette import ENTITY_COLORS, tag_color
 
@@ -29,6 +30,12 @@ def tags_as_ents(doc: Doc):
     doc.set_ents(spans)
 
 
+def tag_raw(tokenizer: Tokenizer, sentence: str) -> Sentence:
+    """Tags the sentence as spaCy would, without pre-tokenizing code and literals, or fixing tokens."""
+    tagger = tokenizer.tagger
+    return Sentence(tagger(tagger.tokenizer.base(sentence), disable=["doc_tokens"]))
+
+
 @router.get("/render/pos", response_class=HTMLResponse)
 def render_pos(sentence: str, retokenize: Optional[bool] = True):
     """Renders the part of speech tags in the provided sentence."""
@@ -38,7 +45,7 @@ def render_pos(sentence: str, retokenize: Optional[bool] = True):
     if retokenize:
         sent = tokenizer.tokenize(sentence)
     else:
-        sent = Sentence(tokenizer.tagger(sentence, disable=["doc_tokens"]))
+        sent = tag_raw(tokenizer, sentence)
 
     tags_as_ents(sent.doc)
     colors = {tag: tag_color(tag) for tag, _, _ in sent.metadata}
@@ -53,11 +60,12 @@ def render_pos(sentence: str, retokenize: Optional[bool] = True):
 
 @router.get("/render/deps", response_class=HTMLResponse)
 def render_dep_graph(sentence: str, retokenize: Optional[bool] = True):
-    tokenizer = Tokenizer()
+    # Dependencies are only produced by the full pipeline
+    tokenizer = Tokenizer(profile=PipelineProfile.FULL)
     if retokenize:
         sent = tokenizer.tokenize(sentence)
     else:
-        sent = Sentence(tokenizer.tagger(sentence, disable=["doc_tokens"]))
+        sent = tag_raw(tokenizer, sentence)
 
     tags_as_ents(sent.doc)
     colors = {tag: tag_color(tag.tag_) for tag in sent.doc}
@@ -72,7 +80,7 @@ def render_dep_graph(sentence: str, retokenize: Optional[bool] = True):
 
 @router.get("/render/{entity_type}", response_class=HTMLResponse)
 def render_entities(sentence: str, entity_type: Entity):
-    sent = Tokenizer().entities(sentence)
+    sent = EntityAnalyzer.from_cache().entities(sentence)
     entity_type = entity_type.lower()
 
     if entity_type == "ner":
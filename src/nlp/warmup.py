@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from enum import Enum
+from os import getenv
+from typing import Dict, List, Optional
+
+try:
+    from tokenizer import SpacyModel, Tokenizer, cache_path, default_profile
+except ModuleNotFoundError:
+    from .tokenizer import SpacyModel, Tokenizer, cache_path, default_profile
+
+LOGGER = logging.getLogger(__name__)
+
+# Tagged (but not cached) after loading each model, so that the first request does not pay for
+# lazily initialized state in the pipeline and matchers.
+WARMUP_SENTENCES = [
+    "Returns `true` if the vector contains no elements.",
+    "Removes the last element from a vector and returns it, or `None` if it is empty.",
+    "Shifts `self` to the left by `n` bits, returning `None` if `n == 0` or `n` is 2u32.",
+    'Returns the number of `\'a\'` characters in "abc", where `s.len() > 0 && s.is_ascii()`.',
+]
+
+
+class LoadState(str, Enum):
+    PENDING = "pending"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __str__(self):
+        return self.value
+
+
+class ModelStatus:
+    def __init__(self, model: SpacyModel):
+        self.model = model
+        self.state = LoadState.PENDING
+        self.timings: Dict[str, float] = {}
+        self.error: Optional[str] = None
+
+    @contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        yield
+        self.timings[stage] = time.perf_counter() - start
+
+    def json(self) -> dict:
+        return {
+            "state": self.state,
+            "timings": self.timings,
+            "error": self.error,
+        }
+
+
+def preload_models() -> List[SpacyModel]:
+    """The models to load at startup, set by PRELOAD_MODELS as a comma-separated list."""
+    models = getenv("PRELOAD_MODELS", "")
+    return [SpacyModel(model.strip()) for model in models.split(",") if model.strip()]
+
+
+class Warmup:
+    """Loads the tagger and opens the caches of each model in a background thread, then tags
+    a warm-up batch, in this process and in each tagging worker (if TAGGER_WORKERS is set).
+    The server reports ready once every model has loaded."""
+
+    def __init__(self, models: List[SpacyModel]):
+        self.models = models
+        self.status = {model: ModelStatus(model) for model in models}
+        self.thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        for model in self.models:
+            status = self.status[model]
+            status.state = LoadState.LOADING
+            LOGGER.info(f"Warming up spacy/{model}")
+            try:
+                self.load(model, status)
+            except Exception as e:
+                LOGGER.exception(f"Failed to load spacy/{model}")
+                status.state = LoadState.FAILED
+                status.error = str(e)
+                continue
+            status.state = LoadState.READY
+            total = sum(status.timings.values())
+            LOGGER.info(f"Loaded spacy/{model} in {total:.3f}s")
+
+    @staticmethod
+    def load(model: SpacyModel, status: ModelStatus):
+        with status.timed("tagger"):
+            Tokenizer.load_tagger(model, default_profile())
+        with status.timed("cache"):
+            tokenizer = Tokenizer.from_cache(cache_path(model), model)
+        with status.timed("warmup"):
+            for _ in tokenizer.tagger.pipe(WARMUP_SENTENCES):
+                pass
+            pool = Tokenizer.POOLS.get(tokenizer.pipeline)
+            if pool is not None:
+                pool.warm_up(WARMUP_SENTENCES)
+
+    @property
+    def ready(self) -> bool:
+        return all(status.state == LoadState.READY for status in self.status.values())
+
+    def json(self) -> dict:
+        return {
+            "ready": self.ready,
+            "models": {str(model): status.json() for model, status in self.status.items()},
+        }